@@ -0,0 +1,79 @@
+"""Сборка случайных персонажей при разных бюджетах памяти AssetStore.
+
+Аксессуары окрашиваются в случайные цвета палитры, поэтому рабочий набор слоёв растёт,
+как у большого пакета ресурсов. Вытесненные тайлы перечитываются из дискового PixelCache.
+
+Запуск из корня проекта: python benchmarks/bench_asset_store.py [--budgets 0 32 8 2] [--samples 300]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from npc_assets import AssetCatalog, AssetStore, PixelCache
+from npc_compositor import CompositingEngine
+from npc_generation import CharacterSampler
+
+PALETTE = [None, (255, 128, 64), (64, 160, 255), (120, 220, 90), (200, 60, 200)]
+
+
+def tinted_tasks(catalog, count, seed):
+    sampler = CharacterSampler(catalog, seed)
+    rnd = random.Random(seed)
+    tasks = []
+    for index in range(count):
+        skin_name, selection = sampler.selection(index)
+        tints = {name: rnd.choice(PALETTE) for names in selection.values() for name in names}
+        tasks.append((skin_name, selection, tints))
+    return tasks
+
+
+def run(extract_path, gender, cache_dir, budget, tasks):
+    store = AssetStore(budget)
+    catalog = AssetCatalog(extract_path, os.path.join(cache_dir, "modified"), gender, pixel_cache=PixelCache(cache_dir), store=store).scan()
+    engine = CompositingEngine(catalog.load_tiles, store=store)
+    skins = {entry.name: entry for entry in catalog.skins}
+    start = time.perf_counter()
+    for skin_name, selection, tints in tasks:
+        selected_accessories = {category: [(name, catalog.find(category, name).tinted(tints[name])) for name in names]
+                                for category, names in selection.items()}
+        engine.compose(skins[skin_name], selected_accessories)
+    return (time.perf_counter() - start) / len(tasks) * 1000, store.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--source", default="extracted_sprites")
+    parser.add_argument("--gender", default="Man")
+    parser.add_argument("--samples", type=int, default=300)
+    parser.add_argument("--budgets", type=int, nargs="+", default=[0, 32, 8, 2], help="Бюджеты в МБ; 0 – без ограничения.")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    megabyte = 1024 * 1024
+    with tempfile.TemporaryDirectory() as cache_dir:
+        catalog = AssetCatalog(args.source, os.path.join(cache_dir, "modified"), args.gender, pixel_cache=PixelCache(cache_dir)).scan()
+        if not catalog.skins:
+            sys.exit(f"Спрайты не найдены в {args.source}")
+        tasks = tinted_tasks(catalog, args.samples, args.seed)
+        # Прогрев дискового кэша: дальше промахи хранилища читают mmap, а не PNG
+        for entry in catalog.skins + [entry for items in catalog.accessories.values() for _, entry in items]:
+            catalog.load_tiles(entry)
+
+        print(f"{args.samples} персонажей ({args.gender}), окраска из {len(PALETTE) - 1} цветов")
+        for budget_mb in args.budgets:
+            budget = budget_mb * megabyte if budget_mb > 0 else None
+            ms, stats = run(args.source, args.gender, cache_dir, budget, tasks)
+            title = f"{budget_mb} МБ" if budget else "без ограничения"
+            total = stats["hits"] + stats["misses"]
+            print(f"{title:>16s}: {ms:6.2f} мс/перс.  пик {stats['peak_bytes'] / megabyte:6.1f} МБ  "
+                  f"в памяти {stats['resident_bytes'] / megabyte:6.1f} МБ  попаданий {stats['hits'] / total:4.0%}  "
+                  f"промахов {stats['misses']:5d}  вытеснено {stats['evictions']:5d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Сравнение старого пути Image.paste с NumPy-движком наложения.
+
+Запуск из корня проекта: python benchmarks/bench_compositing.py [--gender Woman] [--samples 50]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from npc_assets import AssetCatalog, LAYERS_ORDER
+from npc_compositor import CompositingEngine, LayerCompositor, PixelLayer
+
+
+class ImageStore:
+    """Полные декодированные листы в памяти, как их раньше держал каталог."""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.images = {}
+
+    def load(self, entry):
+        image = self.images.get(entry.source_key)
+        if image is None:
+            image = self.images[entry.source_key] = self.catalog.load(entry)
+        return image
+
+    def nbytes(self):
+        return sum(image.width * image.height * 4 for image in self.images.values())
+
+
+def paste_compose(catalog, skin, selected_accessories):
+    # Прежний путь из update_character_display / GenerationWorker.run
+    final_image = catalog.load(skin).copy()
+    for layer in LAYERS_ORDER:
+        if layer == "Skin":
+            continue
+        for name, entry in selected_accessories.get(layer, []):
+            image = catalog.load(entry)
+            if layer == "Back Layers":
+                bg = Image.new("RGBA", final_image.size)
+                bg.paste(image, (0, 0), image)
+                bg.paste(final_image, (0, 0), final_image)
+                final_image = bg
+            else:
+                final_image.paste(image, (0, 0), image)
+    return final_image
+
+
+def random_selections(catalog, count, seed):
+    rnd = random.Random(seed)
+    selections = []
+    for _ in range(count):
+        selected = {}
+        for category, items in catalog.accessories.items():
+            if items and rnd.random() < 0.5:
+                selected[category] = [rnd.choice(items)]
+        selections.append((rnd.choice(catalog.skins), selected))
+    return selections
+
+
+def best_of(repeats, func, selections):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for skin, selected in selections:
+            func(skin, selected)
+        elapsed = (time.perf_counter() - start) / len(selections)
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--extract-path", default="extracted_sprites")
+    parser.add_argument("--gender", default="Woman")
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    catalog = AssetCatalog(args.extract_path, "modified_accessories", args.gender).scan()
+    if not catalog.skins:
+        sys.exit(f"Спрайты не найдены в {args.extract_path}")
+    selections = random_selections(catalog, args.samples, seed=0)
+    store = ImageStore(catalog)
+    engine = CompositingEngine(catalog.load_tiles)
+    # Прогрев: декодирование листов и построение PixelLayer не входят в замер
+    for skin, selected in selections:
+        paste_compose(store, skin, selected)
+        engine.compose(skin, selected)
+
+    paste_ms = best_of(args.repeats, lambda s, sel: paste_compose(store, s, sel), selections)
+    engine_ms = best_of(args.repeats, engine.compose, selections)
+
+    # Интерактивный сценарий: переключение одного аксессуара при уже собранном персонаже
+    compositor = LayerCompositor(engine)
+    skin, selected = selections[0]
+    selected = {category: list(items) for category, items in selected.items()}
+    toggles = [(category, item) for category, items in catalog.accessories.items() for item in items[:3]]
+    for category, item in toggles:
+        compositor.compose(skin, {**selected, category: selected.get(category, []) + [item]})
+    toggle_paste = []
+    toggle_incremental = []
+    for category, item in toggles:
+        state = {**selected, category: selected.get(category, []) + [item]}
+        start = time.perf_counter()
+        paste_compose(catalog, skin, state)
+        toggle_paste.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        compositor.compose(skin, state)
+        toggle_incremental.append(time.perf_counter() - start)
+
+    def median_ms(values):
+        return sorted(values)[len(values) // 2] * 1000
+
+    # Построение слоя: из полного листа и из обрезанных тайлов
+    entries = list(catalog.skins) + [entry for items in catalog.accessories.values() for _, entry in items]
+    build_image = []
+    build_tiles = []
+    for entry in entries:
+        image = store.load(entry)
+        tiles = catalog.load_tiles(entry)
+        start = time.perf_counter()
+        PixelLayer.from_image(image)
+        build_image.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        PixelLayer.from_tiles(tiles)
+        build_tiles.append(time.perf_counter() - start)
+
+    layers = sum(len(items) for _, sel in selections for items in sel.values()) / len(selections) + 1
+    print(f"Пол: {args.gender}, образцов: {len(selections)}, слоёв в среднем: {layers:.1f}")
+    print(f"Полная сборка, Image.paste:        {paste_ms:7.2f} мс")
+    print(f"Полная сборка, CompositingEngine:  {engine_ms:7.2f} мс  (x{paste_ms / engine_ms:.2f})")
+    print(f"Переключение, Image.paste:         {median_ms(toggle_paste):7.2f} мс")
+    print(f"Переключение, LayerCompositor:     {median_ms(toggle_incremental):7.2f} мс  "
+          f"(x{median_ms(toggle_paste) / median_ms(toggle_incremental):.2f})")
+    megabyte = 1024 * 1024
+    print(f"Листы в памяти ({len(store.images)}), полные RGBA: {store.nbytes() / megabyte:7.1f} МБ")
+    print(f"Те же листы, обрезанные тайлы:   {catalog.resident_bytes() / megabyte:7.1f} МБ")
+    print(f"Слои PixelLayer движка:          {engine.cached_bytes() / megabyte:7.1f} МБ")
+    print(f"Построение слоя из листа:          {median_ms(build_image):7.2f} мс")
+    print(f"Построение слоя из тайлов:         {median_ms(build_tiles):7.2f} мс  "
+          f"(x{median_ms(build_image) / median_ms(build_tiles):.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Сравнение прежнего pil2pixmap с мостом npc_qtimage на листе 800x448.
+
+Запуск из корня проекта: python benchmarks/bench_qtimage.py [--repeats 200]
+Без дисплея: QT_QPA_PLATFORM=offscreen python benchmarks/bench_qtimage.py
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtWidgets import QApplication
+
+from npc_assets import shared_image
+from npc_qtimage import to_qimage, to_pixmap
+
+
+def pil2pixmap(image):
+    # Прежний путь из SpriteCustomizer и AnimationWindow
+    image = image.convert("RGBA")
+    data = image.tobytes("raw", "RGBA")
+    qim = QImage(data, image.width, image.height, QImage.Format_RGBA8888)
+    return QPixmap.fromImage(qim)
+
+
+def pil2qimage(image):
+    image = image.convert("RGBA")
+    data = image.tobytes("raw", "RGBA")
+    return QImage(data, image.width, image.height, QImage.Format_RGBA8888)
+
+
+def best_of(repeats, func, source):
+    func(source)
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(source)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=448)
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+    app = QApplication(sys.argv[:1])
+
+    # Случайные пиксели с прозрачными областями, как у листа спрайтов
+    rnd = np.random.default_rng(0)
+    pixels = rnd.integers(0, 256, (args.height, args.width, 4), dtype=np.uint8)
+    pixels[..., 3] = np.where(pixels[..., 3] < 128, 0, 255)
+    size = (args.width, args.height)
+    plain = Image.frombytes("RGBA", size, pixels.tobytes())
+    shared = shared_image(pixels, size)
+    rgb = plain.convert("RGB")
+
+    print(f"Лист {args.width}x{args.height}, лучшее из {args.repeats}")
+    rows = [
+        ("QImage, PIL RGBA", pil2qimage, to_qimage, plain),
+        ("QImage, PIL RGBA (общий буфер)", pil2qimage, to_qimage, shared),
+        ("QImage, массив NumPy", lambda a: pil2qimage(Image.fromarray(a)), to_qimage, pixels),
+        ("QPixmap, PIL RGB", pil2pixmap, to_pixmap, rgb),
+        ("QPixmap, PIL RGBA", pil2pixmap, to_pixmap, plain),
+        ("QPixmap, PIL RGBA (общий буфер)", pil2pixmap, to_pixmap, shared),
+        ("QPixmap, массив NumPy", lambda a: pil2pixmap(Image.fromarray(a)), to_pixmap, pixels),
+    ]
+    for title, old, new, source in rows:
+        old_ms = best_of(args.repeats, old, source)
+        new_ms = best_of(args.repeats, new, source)
+        print(f"{title:34s} pil2pixmap {old_ms:7.3f} мс   мост {new_ms:7.3f} мс  (x{old_ms / new_ms:.1f})")
+    app.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1071 @@
+import io
+import os
+import sys
+import json
+import zlib
+import mmap
+import struct
+import hashlib
+import tarfile
+import zipfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from npc_writer import atomic_write
+
+# Определение базовой директории: если собрано в EXE – рядом с EXE, иначе рядом со скриптом.
+def get_base_dir():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    else:
+        return os.path.dirname(os.path.abspath(__file__))
+
+BASE_DIR = get_base_dir()
+
+ARCHIVE_EXTENSIONS = [".zip", ".tar", ".tgz", ".tar.gz", ".rar", ".7z"]
+
+def find_default_archive():
+    """Ищет в BASE_DIR архив с именем Construct с поддерживаемым расширением."""
+    for ext in ARCHIVE_EXTENSIONS:
+        candidate = os.path.join(BASE_DIR, "Construct" + ext)
+        if os.path.exists(candidate):
+            return candidate
+    return ""  # Если не найден
+
+# Порядок слоёв снизу вверх; "Skin" – базовый слой, остальные – категории аксессуаров.
+LAYERS_ORDER = [
+    "Back Layers",
+    "Skin",
+    "Clothing",
+    "Hair",
+    "Hat",
+    "Mask",
+    "Arm Layers",
+    "Ears",
+    "Hand",
+    "Hostage Layers"
+]
+
+GENDERS = ["Man", "Woman"]
+# Имена окрашенных копий аксессуаров в modified_accessories
+MODIFIED_PREFIX = "modified_"
+
+
+def selection_tint(name, tint):
+    """Окраска, с которой выбирается аксессуар name: modified_ файлы уже окрашены при сохранении."""
+    return None if name.startswith(MODIFIED_PREFIX) else tint
+
+
+# ------------------------- Распаковка архива -------------------------
+class ArchiveError(Exception):
+    """Ошибка распаковки с сообщением для пользователя."""
+
+
+# Загрузчик читает только PNG: .meta-файлы Unity не распаковываются
+SKIPPED_SUFFIXES = (".meta",)
+EXTRACT_MANIFEST = ".extract_manifest.json"
+
+
+def archive_extension(archive_path):
+    lower = archive_path.lower()
+    for ext in sorted(ARCHIVE_EXTENSIONS, key=len, reverse=True):
+        if lower.endswith(ext):
+            return ext
+    return os.path.splitext(lower)[1]
+
+
+def member_name(name):
+    """Нормализованное имя члена архива или None для пропускаемых и небезопасных имён."""
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or name.startswith(("/", "\\")) or ".." in parts or ":" in parts[0]:
+        return None
+    if parts[-1].endswith(SKIPPED_SUFFIXES):
+        return None
+    return "/".join(parts)
+
+
+def member_target(extract_path, name):
+    return os.path.join(extract_path, *name.split("/"))
+
+
+def read_extract_manifest(extract_path):
+    try:
+        with open(os.path.join(extract_path, EXTRACT_MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        return manifest if isinstance(manifest.get("members"), dict) else None
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def extract_archive(archive_path, extract_path, progress=None, workers=None):
+    """Распаковывает архив в extract_path, обновляя только изменившиеся файлы.
+
+    В extract_path пишется манифест: размер и CRC (у tar – mtime) каждого члена, а также
+    размер и mtime самого архива. Неизменный архив при повторном вызове не читается
+    вовсе; у изменённого распаковываются только члены с другими размером или
+    контрольной суммой, а файлы, исчезнувшие из архива, удаляются. Члены zip и rar
+    распаковываются параллельно. progress(done, total) получает прочитанные байты
+    архива. Возвращает число записанных и удалённых файлов.
+    """
+    os.makedirs(extract_path, exist_ok=True)
+    stat = os.stat(archive_path)
+    state = [os.path.basename(archive_path), stat.st_size, stat.st_mtime]
+    manifest = read_extract_manifest(extract_path) or {"members": {}}
+    old_members = manifest["members"]
+    if manifest.get("archive") == state and all(
+            is_extracted(extract_path, name, member, member) for name, member in old_members.items()):
+        if progress is not None:
+            progress(stat.st_size, stat.st_size)
+        return 0
+
+    ext = archive_extension(archive_path)
+    try:
+        if ext == ".zip":
+            members, written = _extract_parallel(zipfile.ZipFile, archive_path, extract_path, old_members,
+                                                 progress, workers)
+        elif ext in [".tar", ".tgz", ".tar.gz"]:
+            members, written = _extract_tar(archive_path, extract_path, old_members, progress)
+        elif ext == ".rar":
+            try:
+                import rarfile
+            except ImportError:
+                raise ArchiveError("Модуль rarfile не установлен. Установите его (pip install rarfile).")
+            try:
+                members, written = _extract_parallel(rarfile.RarFile, archive_path, extract_path, old_members,
+                                                     progress, workers)
+            except Exception as e:
+                raise ArchiveError(f"Не удалось открыть RAR архив: {e}")
+        elif ext == ".7z":
+            try:
+                import py7zr
+            except ImportError:
+                raise ArchiveError("Модуль py7zr не установлен. Установите его (pip install py7zr).")
+            try:
+                members, written = _extract_7z(py7zr, archive_path, extract_path, old_members, progress)
+            except Exception as e:
+                raise ArchiveError(f"Ошибка при открытии 7z архива: {e}")
+        else:
+            raise ArchiveError(f"Формат архива '{ext}' не поддерживается.")
+    except (zipfile.BadZipFile, tarfile.TarError, zlib.error) as e:
+        raise ArchiveError(f"Не удалось распаковать архив '{archive_path}': {e}")
+
+    removed = 0
+    for name in old_members.keys() - members.keys():
+        try:
+            os.remove(member_target(extract_path, name))
+            removed += 1
+        except OSError:
+            pass
+    manifest = {"archive": state, "members": members}
+    atomic_write(os.path.join(extract_path, EXTRACT_MANIFEST), json.dumps(manifest, ensure_ascii=False).encode("utf-8"))
+    return written + removed
+
+
+def is_extracted(extract_path, name, member, old_member):
+    """True, если файл члена уже распакован из той же версии (размер и контрольная сумма)."""
+    if old_member is None or list(member) != list(old_member):
+        return False
+    try:
+        return os.path.getsize(member_target(extract_path, name)) == member[0]
+    except OSError:
+        return False
+
+
+def _extract_parallel(open_archive, archive_path, extract_path, old_members, progress, workers):
+    # zip и rar: член читается независимо от остальных, zlib отпускает GIL
+    with open_archive(archive_path) as archive:
+        infos = [info for info in archive.infolist() if not info.is_dir()]
+    members = {}
+    jobs = []
+    for info in infos:
+        name = member_name(info.filename)
+        if name is None:
+            continue
+        members[name] = [info.file_size, info.CRC]
+        if not is_extracted(extract_path, name, members[name], old_members.get(name)):
+            jobs.append((info, member_target(extract_path, name)))
+
+    total = sum(info.compress_size for info, _ in jobs)
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def extract(job):
+        info, target = job
+        archive = getattr(local, "archive", None)
+        if archive is None:
+            archive = local.archive = open_archive(archive_path)
+            with lock:
+                handles.append(archive)
+        atomic_write(target, archive.read(info))
+        return info.compress_size
+
+    done = 0
+    if progress is not None:
+        progress(done, total)
+    try:
+        with ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1)) as pool:
+            for size in pool.map(extract, jobs):
+                done += size
+                if progress is not None:
+                    progress(done, total)
+    finally:
+        for archive in handles:
+            archive.close()
+    return members, len(jobs)
+
+
+def _extract_tar(archive_path, extract_path, old_members, progress):
+    # tar (в том числе сжатый) читается одним последовательным проходом; прогресс – по сжатым байтам
+    total = os.path.getsize(archive_path)
+    members = {}
+    written = 0
+    with open(archive_path, "rb") as raw, tarfile.open(fileobj=raw, mode="r:*") as archive:
+        for info in archive:
+            if progress is not None:
+                progress(raw.tell(), total)
+            name = member_name(info.name)
+            # Ссылки и устройства не распаковываются: загрузчику нужны только обычные файлы
+            if name is None or not info.isfile():
+                continue
+            members[name] = [info.size, int(info.mtime)]
+            if not is_extracted(extract_path, name, members[name], old_members.get(name)):
+                atomic_write(member_target(extract_path, name), archive.extractfile(info).read())
+                written += 1
+    if progress is not None:
+        progress(total, total)
+    return members, written
+
+
+def _extract_7z(py7zr, archive_path, extract_path, old_members, progress):
+    # 7z обычно "сплошной": члены распаковываются одним вызовом по списку изменившихся
+    total = os.path.getsize(archive_path)
+    members = {}
+    targets = []
+    with py7zr.SevenZipFile(archive_path, mode="r") as archive:
+        for info in archive.list():
+            name = member_name(info.filename)
+            if name is None or info.is_directory:
+                continue
+            members[name] = [info.uncompressed, info.crc32]
+            if not is_extracted(extract_path, name, members[name], old_members.get(name)):
+                targets.append(info.filename)
+        if targets:
+            archive.reset()
+            archive.extract(path=extract_path, targets=targets)
+    if progress is not None:
+        progress(total, total)
+    return members, len(targets)
+
+
+# ------------------------- Чтение ресурсов прямо из архива -------------------------
+# Несжатый tar и zip читаются по смещениям членов без распаковки на диск; для tar.gz,
+# rar и 7z произвольный доступ дорог, они по-прежнему распаковываются.
+DIRECT_ARCHIVE_EXTENSIONS = [".zip", ".tar"]
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+ZIP_LOCAL_MAGIC = b"PK\x03\x04"
+
+
+def can_read_directly(archive_path):
+    return os.path.isfile(archive_path) and archive_extension(archive_path) in DIRECT_ARCHIVE_EXTENSIONS
+
+
+class ArchiveSource:
+    """Спрайты внутри zip или несжатого tar без распаковки.
+
+    При открытии строится индекс PNG-членов: смещение данных, размеры, способ сжатия и
+    размер листа из заголовка PNG. Индекс сохраняется рядом с архивом
+    (<архив>.index.json) и используется повторно, пока не изменились размер и mtime
+    архива, так что повторное открытие и процессы генерации не читают архив целиком.
+    Пиксели декодируются по требованию из байтов члена. Пути записей – виртуальные:
+    <путь архива>/<имя члена>.
+    """
+
+    INDEX_VERSION = 1
+
+    def __init__(self, archive_path):
+        self.archive_path = os.path.abspath(archive_path)
+        self.index_path = self.archive_path + ".index.json"
+        stat = os.stat(self.archive_path)
+        self.archive_size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.kind = archive_extension(self.archive_path)
+        self._file = open(self.archive_path, "rb")
+        self._lock = threading.Lock()
+        self.members = self._read_index()
+        if self.members is None:
+            try:
+                self.members = self._build_index()
+            except (zipfile.BadZipFile, tarfile.TarError) as e:
+                self._file.close()
+                raise ArchiveError(f"Не удалось прочитать архив '{archive_path}': {e}")
+            self._save_index()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if (index.get("version") != self.INDEX_VERSION or index.get("archive_size") != self.archive_size
+                    or index.get("archive_mtime") != self.mtime):
+                return None
+            return {name: tuple(member) for name, member in index["members"].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _save_index(self):
+        index = {"version": self.INDEX_VERSION, "archive_size": self.archive_size,
+                 "archive_mtime": self.mtime, "members": self.members}
+        try:
+            atomic_write(self.index_path, json.dumps(index, ensure_ascii=False).encode("utf-8"))
+        except OSError:
+            # Папка архива только для чтения – индекс будет строиться при каждом открытии
+            pass
+
+    def _build_index(self):
+        # Член: (смещение данных, сжатый размер, размер, способ сжатия, crc32, ширина, высота)
+        members = {}
+        for name, member in self._scan_members():
+            try:
+                with Image.open(io.BytesIO(self._read(member))) as image:
+                    width, height = image.size
+            except Exception:
+                continue
+            members[name] = member + (width, height)
+        return members
+
+    def _scan_members(self):
+        if self.kind == ".zip":
+            with zipfile.ZipFile(self.archive_path) as archive:
+                infos = archive.infolist()
+            for info in infos:
+                if info.is_dir() or not info.filename.endswith(".png"):
+                    continue
+                # Смещение данных задаёт локальный заголовок: его поля имени и extra
+                # могут отличаться от центрального каталога
+                header = self._read_at(info.header_offset, ZIP_LOCAL_HEADER.size)
+                fields = ZIP_LOCAL_HEADER.unpack(header)
+                if fields[0] != ZIP_LOCAL_MAGIC:
+                    raise ArchiveError(f"Повреждённый zip-архив: {self.archive_path}")
+                offset = info.header_offset + ZIP_LOCAL_HEADER.size + fields[10] + fields[11]
+                yield (info.filename,
+                       (offset, info.compress_size, info.file_size, info.compress_type, info.CRC))
+        else:
+            with tarfile.open(self.archive_path, "r:") as archive:
+                for info in archive:
+                    if info.isfile() and info.name.endswith(".png"):
+                        name = info.name[2:] if info.name.startswith("./") else info.name
+                        yield name, (info.offset_data, info.size, info.size, zipfile.ZIP_STORED, None)
+
+    def _read_at(self, offset, size):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def _read(self, member):
+        offset, compress_size, size, method, crc = member[:5]
+        data = self._read_at(offset, compress_size)
+        if method == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        elif method != zipfile.ZIP_STORED:
+            raise ArchiveError(f"Способ сжатия {method} не поддерживается: распакуйте архив.")
+        if len(data) != size or (crc is not None and zlib.crc32(data) != crc):
+            raise ArchiveError(f"Повреждённый член архива {self.archive_path}.")
+        return data
+
+    def path(self, name):
+        return os.path.join(self.archive_path, *name.split("/"))
+
+    def walk(self, base):
+        """Как os.walk для папки base внутри архива: (категория, файл, виртуальный путь)."""
+        prefix = base.strip("/") + "/"
+        for name in self.members:
+            if name.startswith(prefix):
+                folder, file = name.rsplit("/", 1)
+                yield folder.rsplit("/", 1)[-1], file, self.path(name)
+
+    def entry(self, name, path, category):
+        member = self.members[self._member_name(path)]
+        return AssetEntry(name, path, category, (member[5], member[6]), member[2], self.mtime)
+
+    def _member_name(self, path):
+        return os.path.relpath(path, self.archive_path).replace(os.sep, "/")
+
+    def __contains__(self, path):
+        return path.startswith(self.archive_path + os.sep) and self._member_name(path) in self.members
+
+    def read_bytes(self, path):
+        return self._read(self.members[self._member_name(path)])
+
+    def open_image(self, path):
+        return Image.open(io.BytesIO(self.read_bytes(path)))
+
+    def close(self):
+        self._file.close()
+
+
+# ------------------------- Манифест ресурсов -------------------------
+class AssetEntry:
+    """Запись манифеста: имя, путь, категория и размер листа (пиксели не декодируются).
+
+    tint – цвет (r, g, b), которым слой умножается при отрисовке; окрашенная запись
+    ссылается на тот же файл, но имеет собственный key.
+    """
+    __slots__ = ("name", "path", "category", "size", "file_size", "mtime", "tint")
+
+    def __init__(self, name, path, category, size, file_size, mtime, tint=None):
+        self.name = name
+        self.path = path
+        self.category = category
+        self.size = size
+        self.file_size = file_size
+        self.mtime = mtime
+        self.tint = tint
+
+    @property
+    def source_key(self):
+        """Ключ пикселей файла (без учёта окраски)."""
+        return (self.path, self.file_size, self.mtime)
+
+    @property
+    def key(self):
+        if self.tint is None:
+            return self.source_key
+        return self.source_key + (self.tint,)
+
+    def tinted(self, tint):
+        """Та же запись с окраской tint (None – без окраски)."""
+        tint = tuple(tint) if tint is not None else None
+        return AssetEntry(self.name, self.path, self.category, self.size, self.file_size, self.mtime, tint)
+
+    def __repr__(self):
+        tint = f", tint={self.tint}" if self.tint is not None else ""
+        return f"AssetEntry({self.category!r}, {self.name!r}, {self.size}{tint})"
+
+
+def read_image_size(path):
+    # Image.open читает только заголовок PNG, декодирование пикселей откладывается до load()
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except Exception:
+        return None
+
+
+def make_entry(name, path, category):
+    stat = os.stat(path)
+    size = read_image_size(path)
+    if size is None:
+        return None
+    return AssetEntry(name, path, category, size, stat.st_size, stat.st_mtime)
+
+
+# ------------------------- Общие пиксельные буферы -------------------------
+def shared_image(buffer, size):
+    """RGBA-изображение поверх буфера (bytes, mmap, массив NumPy) без копирования.
+
+    Буфер запоминается при изображении, и image_buffer() отдаёт его, например, мосту в Qt.
+    Такое изображение только для чтения: при первом изменении PIL копирует пиксели и
+    буфер перестаёт с ним совпадать.
+    """
+    image = Image.frombuffer("RGBA", size, buffer, "raw", "RGBA", 0, 1)
+    image.shared_buffer = buffer
+    return image
+
+
+def image_buffer(image):
+    """Буфер RGBA-пикселей, общий с изображением, или None."""
+    buffer = getattr(image, "shared_buffer", None)
+    if buffer is None or not image.readonly:
+        return None
+    return buffer
+
+
+# ------------------------- Обрезанные тайлы кадров -------------------------
+# Ячейка сетки кадров листа: 10 x 7 ячеек на листе 800x448
+FRAME_CELL = (80, 64)
+
+
+class SpriteTiles:
+    """Лист в виде обрезанных тайлов: по ячейкам сетки кадров, только непрозрачная часть.
+
+    tiles – список (x, y, пиксели (h, w, 4) uint8): рамка непрозрачных пикселей каждой
+    непустой ячейки; пустые ячейки не хранятся. Шляпа или предмет в руке занимают
+    малую часть кадра, поэтому тайлы в десятки раз меньше полного листа. Пиксели с
+    нулевой альфой не сохраняются: при восстановлении листа их цвет нулевой.
+    """
+    __slots__ = ("size", "tiles")
+
+    def __init__(self, size, tiles):
+        self.size = size
+        self.tiles = tiles
+
+    @classmethod
+    def from_image(cls, image, cell=FRAME_CELL):
+        image = image if image.mode == "RGBA" else image.convert("RGBA")
+        pixels = np.asarray(image)
+        alpha = pixels[:, :, 3]
+        cell_width, cell_height = cell
+        tiles = []
+        for top in range(0, image.height, cell_height):
+            band = alpha[top:top + cell_height]
+            # Сначала отбрасываются пустые полосы, затем пустые ячейки внутри полосы
+            if not band.any():
+                continue
+            columns = band.any(axis=0)
+            for left in range(0, image.width, cell_width):
+                xs = np.flatnonzero(columns[left:left + cell_width])
+                if not len(xs):
+                    continue
+                ys = np.flatnonzero(band[:, left + xs[0]:left + xs[-1] + 1].any(axis=1))
+                x0, x1 = left + int(xs[0]), left + int(xs[-1]) + 1
+                y0, y1 = top + int(ys[0]), top + int(ys[-1]) + 1
+                tile = pixels[y0:y1, x0:x1].copy()
+                tile[tile[:, :, 3] == 0] = 0
+                tiles.append((x0, y0, tile))
+        return cls(image.size, tiles)
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for _, _, tile in self.tiles)
+
+    def to_array(self):
+        width, height = self.size
+        pixels = np.zeros((height, width, 4), dtype=np.uint8)
+        for x, y, tile in self.tiles:
+            pixels[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+        return pixels
+
+    def to_image(self):
+        return shared_image(self.to_array(), self.size)
+
+
+# ------------------- Хранилище декодированных ресурсов в памяти -------------------
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением по объёму и/или числу значений.
+
+    Объём значения – nbytes, переданный в put(), иначе атрибут value.nbytes. При
+    превышении max_bytes или max_items вытесняются давно не использованные значения;
+    закреплённые (pinned) не вытесняются. None – без ограничения. Счётчики попаданий,
+    промахов, вытеснений и пик объёма нужны для подбора бюджета.
+    """
+
+    def __init__(self, max_bytes=None, max_items=None):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.peak_bytes = 0
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, load=None):
+        """Значение по ключу; при промахе строит его через load() и запоминает (без load – None)."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return item[0]
+            self.misses += 1
+        if load is None:
+            return None
+        # Построение – вне блокировки; если ключ успел построить другой поток, берётся его значение
+        value = load()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                return item[0]
+            self._insert(key, value, None, False)
+        return value
+
+    def put(self, key, value, nbytes=None, pinned=False):
+        with self._lock:
+            self._insert(key, value, nbytes, pinned)
+
+    def _insert(self, key, value, nbytes, pinned):
+        old = self._items.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        nbytes = value.nbytes if nbytes is None else nbytes
+        if not pinned and self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        self._items[key] = (value, nbytes, pinned)
+        self._bytes += nbytes
+        if self._full():
+            for old_key in list(self._items):
+                if not self._full():
+                    break
+                _, size, old_pinned = self._items[old_key]
+                if old_pinned:
+                    continue
+                del self._items[old_key]
+                self._bytes -= size
+                self.evictions += 1
+        self.peak_bytes = max(self.peak_bytes, self._bytes)
+
+    def _full(self):
+        return ((self.max_bytes is not None and self._bytes > self.max_bytes)
+                or (self.max_items is not None and len(self._items) > self.max_items))
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def item_bytes(self, key):
+        item = self._items.get(key)
+        return item[1] if item is not None else 0
+
+    def discard(self, keys):
+        with self._lock:
+            for key in keys:
+                item = self._items.pop(key, None)
+                if item is not None:
+                    self._bytes -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        with self._lock:
+            return {"items": len(self._items), "resident_bytes": self._bytes, "peak_bytes": self.peak_bytes,
+                    "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+class AssetStore(LRUCache):
+    """Общее LRU-хранилище декодированных ресурсов с бюджетом памяти.
+
+    Значения – всё, у чего есть nbytes (SpriteTiles каталога, PixelLayer движка
+    наложения); ключ – кортеж, первый элемент которого задаёт вид значения ("tiles",
+    "layer"). При превышении max_bytes вытесняются давно не использованные значения:
+    следующий get() снова построит их через load() из дискового кэша, папки или архива.
+    Закреплённые значения (пиксели, которых ещё нет на диске) не вытесняются.
+    max_bytes=None – без ограничения.
+    """
+
+    def __init__(self, max_bytes=None):
+        super().__init__(max_bytes)
+
+    def clear(self, kind=None):
+        """Удаляет все значения или только значения вида kind."""
+        if kind is None:
+            super().clear()
+            return
+        with self._lock:
+            for key in [key for key in self._items if key[0] == kind]:
+                self._bytes -= self._items.pop(key)[1]
+
+    def kind_bytes(self, kind):
+        with self._lock:
+            return sum(item[1] for key, item in self._items.items() if key[0] == kind)
+
+    def report(self):
+        stats = self.stats()
+        megabyte = 1024 * 1024
+        budget = "без ограничения" if self.max_bytes is None else f"из {self.max_bytes / megabyte:.0f} МБ"
+        total = stats["hits"] + stats["misses"]
+        rate = stats["hits"] / total if total else 0.0
+        return (f"{stats['items']} ресурсов, {stats['resident_bytes'] / megabyte:.1f} МБ {budget} "
+                f"(пик {stats['peak_bytes'] / megabyte:.1f} МБ); попаданий {stats['hits']}, "
+                f"промахов {stats['misses']} ({rate:.0%}), вытеснено {stats['evictions']}")
+
+
+# ------------------- Дисковый кэш декодированных пикселей -------------------
+class PixelCache:
+    """Кэш декодированных RGBA-буферов на диске.
+
+    Каждый лист хранится отдельным файлом: 16-байтный заголовок и сырые RGBA-пиксели,
+    которые отображаются в память через mmap без повторного zlib-декодирования PNG.
+    Ключ включает путь, размер и mtime исходника, поэтому изменённый спрайт или
+    перекрашенный modified_ файл автоматически получает новую запись. Рядом хранятся
+    сырые байтовые записи (get_bytes/put_bytes, например маски заполненности). Общий объём
+    ограничен max_bytes; при превышении удаляются давно не использованные записи (время
+    последнего обращения хранится в mtime файла кэша). Занятый объём считается по
+    папке один раз и дальше ведётся нарастающим итогом, поэтому запись не сканирует
+    папку, пока кэш не переполнен.
+    """
+
+    MAGIC = b"NPCRGBA1"
+    HEADER = struct.Struct("<8sII")
+    SUFFIX = ".rgba"
+    RAW_SUFFIX = ".bin"
+    SUFFIXES = (SUFFIX, RAW_SUFFIX)
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._bytes = None
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _blob_path(self, key, suffix=SUFFIX):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest + suffix)
+
+    def get(self, key):
+        """Возвращает изображение поверх mmap-буфера или None, если записи нет."""
+        blob_path = self._blob_path(key)
+        try:
+            with open(blob_path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(mapped) < self.HEADER.size:
+            mapped.close()
+            return None
+        magic, width, height = self.HEADER.unpack_from(mapped, 0)
+        if magic != self.MAGIC or len(mapped) != self.HEADER.size + width * height * 4:
+            mapped.close()
+            return None
+        try:
+            os.utime(blob_path)
+        except OSError:
+            pass
+        # frombuffer в режиме "raw" RGBA не копирует данные: изображение только для чтения
+        return shared_image(memoryview(mapped)[self.HEADER.size:], (width, height))
+
+    def put(self, key, image):
+        image = image if image.mode == "RGBA" else image.convert("RGBA")
+        self._write(self._blob_path(key), [self.HEADER.pack(self.MAGIC, image.width, image.height),
+                                           image.tobytes("raw", "RGBA")])
+
+    def get_bytes(self, key):
+        """Сырая запись, сохранённая put_bytes, или None."""
+        blob_path = self._blob_path(key, self.RAW_SUFFIX)
+        try:
+            with open(blob_path, "rb") as f:
+                data = f.read()
+            os.utime(blob_path)
+        except OSError:
+            return None
+        return data
+
+    def put_bytes(self, key, data):
+        self._write(self._blob_path(key, self.RAW_SUFFIX), [data])
+
+    def _write(self, blob_path, parts):
+        try:
+            atomic_write(blob_path, parts)
+        except OSError:
+            return
+        self._added(sum(len(part) for part in parts))
+
+    def _added(self, size):
+        with self._lock:
+            if self._bytes is None:
+                # Первая запись процесса: объём папки (уже с новым файлом) считается один раз
+                self._bytes = self._scan()[1]
+            else:
+                self._bytes += size
+            full = self._bytes > self.max_bytes
+        if full:
+            # Запас в 10%: следующие записи не упираются в предел и не сканируют папку
+            self.evict(self.max_bytes * 9 // 10)
+
+    def _scan(self):
+        blobs = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(self.SUFFIXES):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        return blobs, total
+
+    def evict(self, target=None):
+        """Удаляет давно не использованные записи, пока объём больше target (по умолчанию max_bytes)."""
+        target = self.max_bytes if target is None else target
+        with self._lock:
+            # Точный объём по папке: в неё могут писать и другие процессы
+            blobs, total = self._scan()
+            blobs.sort()
+            for _, size, path in blobs:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Файл может быть отображён в память (Windows) – пропускаем
+                    continue
+                total -= size
+            self._bytes = total
+
+    def total_bytes(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir)
+                   if entry.name.endswith(self.SUFFIXES))
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(self.SUFFIXES):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        with self._lock:
+            self._bytes = None
+
+
+# ------------------------- Атлас миниатюр -------------------------
+def render_thumbnail(image, size=128, frame=(0, 0, 64, 64)):
+    """Миниатюра аксессуара: первый кадр листа, увеличенный до size x size."""
+    return image.crop(frame).resize((size, size), Image.LANCZOS)
+
+
+class ThumbnailAtlas:
+    """Миниатюры ресурсов в одном файле на диске.
+
+    atlas.rgba – подряд идущие ячейки size x size сырых RGBA-пикселей, atlas.json – какая
+    ячейка принадлежит какому ключу (путь, размер, mtime). Миниатюра строится один раз
+    на версию файла; новые ресурсы дописываются в конец без перезаписи атласа. Ячейки
+    устаревших версий остаются в файле до clear().
+    """
+
+    def __init__(self, cache_dir, size=128):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.cell_bytes = size * size * 4
+        self.data_path = os.path.join(cache_dir, "atlas.rgba")
+        self.index_path = os.path.join(cache_dir, "atlas.json")
+        self._lock = threading.Lock()
+        self._dirty = False
+        os.makedirs(cache_dir, exist_ok=True)
+        self._slots = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("size") != self.size:
+                return {}
+            cells = os.path.getsize(self.data_path) // self.cell_bytes
+            return {digest: slot for digest, slot in index["slots"].items() if slot < cells}
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+    def get(self, entry, load):
+        """Миниатюра записи; при отсутствии строится из load(entry) и дописывается в атлас."""
+        digest = self._digest(entry.source_key)
+        with self._lock:
+            slot = self._slots.get(digest)
+        if slot is not None:
+            try:
+                with open(self.data_path, "rb") as f:
+                    f.seek(slot * self.cell_bytes)
+                    data = f.read(self.cell_bytes)
+                if len(data) == self.cell_bytes:
+                    return shared_image(data, (self.size, self.size))
+            except OSError:
+                pass
+        thumbnail = render_thumbnail(load(entry), self.size).convert("RGBA")
+        if entry.file_size is not None:
+            # Запись без файла на диске (ещё пишется) в атлас не попадает: её ключ временный
+            self._append(digest, thumbnail)
+        return thumbnail
+
+    def _append(self, digest, thumbnail):
+        with self._lock:
+            try:
+                with open(self.data_path, "ab") as f:
+                    slot = f.tell() // self.cell_bytes
+                    f.write(thumbnail.tobytes("raw", "RGBA"))
+            except OSError:
+                return
+            self._slots[digest] = slot
+            self._dirty = True
+
+    def save(self):
+        """Сохраняет индекс, если с прошлого раза добавились миниатюры."""
+        with self._lock:
+            if not self._dirty:
+                return
+            index = {"size": self.size, "slots": dict(self._slots)}
+            self._dirty = False
+        try:
+            atomic_write(self.index_path, json.dumps(index).encode("utf-8"))
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(self._slots)
+
+    def clear(self):
+        with self._lock:
+            self._slots = {}
+            self._dirty = False
+            for path in (self.data_path, self.index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class AssetCatalog:
+    """Каталог спрайтов одного пола.
+
+    При сканировании собирается только манифест (имена, пути, категории, размеры);
+    пиксели декодируются по требованию и хранятся в виде SpriteTiles в store
+    (AssetStore, общий для каталогов и движка наложения, с бюджетом памяти), а load()
+    собирает из них полный лист на время использования. extract_path – папка
+    распаковки или сам архив zip/tar (см. ArchiveSource); source – общий
+    ArchiveSource, если он уже открыт для другого пола.
+    """
+
+    def __init__(self, extract_path, modified_path, gender, layers_order=LAYERS_ORDER, pixel_cache=None,
+                 source=None, store=None):
+        self.extract_path = extract_path
+        if source is None and can_read_directly(extract_path):
+            source = ArchiveSource(extract_path)
+        self.source = source
+        self.modified_path = modified_path
+        self.gender = gender
+        self.layers_order = layers_order
+        self.pixel_cache = pixel_cache
+        self.skins = []
+        self.accessories = {layer: [] for layer in layers_order if layer != "Skin"}
+        self.file_paths = {}
+        self.store = store if store is not None else AssetStore()
+
+    def scan(self):
+        self.skins = []
+        self.accessories = {layer: [] for layer in self.layers_order if layer != "Skin"}
+        self.file_paths = {}
+
+        if self.source is not None:
+            files = self.source.walk(f"Construct/{self.gender}")
+        else:
+            files = self._walk_png(os.path.join(self.extract_path, "Construct", self.gender))
+        for category, file, image_path in files:
+            if category == "Skin":
+                entry = self._make_entry(file, image_path, category)
+                if entry is not None:
+                    self.skins.append(entry)
+            elif category in self.accessories:
+                self._add_entry(category, file, image_path)
+
+        # Модифицированные аксессуары могут лежать и в категориях, которых нет в архиве
+        modified_base_path = os.path.join(self.modified_path, self.gender)
+        for category, file, image_path in self._walk_png(modified_base_path):
+            self.accessories.setdefault(category, [])
+            self._add_entry(category, file, image_path)
+        return self
+
+    def _walk_png(self, base_path):
+        if not os.path.exists(base_path):
+            return
+        for root, dirs, files in os.walk(base_path):
+            category = os.path.basename(root)
+            for file in files:
+                if file.endswith(".png"):
+                    yield category, file, os.path.join(root, file)
+
+    def _add_entry(self, category, name, path, image=None):
+        if image is not None and not os.path.exists(path):
+            # Файл ещё пишется в фоне: запись строится по изображению в памяти,
+            # а в дисковый кэш не попадает – при следующем сканировании ключ будет другим
+            entry = AssetEntry(name, path, category, image.size, None, None)
+        else:
+            entry = self._make_entry(name, path, category)
+        if entry is None:
+            return None
+        self.accessories[category].append((name, entry))
+        self.file_paths[(category, name)] = path
+        if image is not None:
+            # Пока файла нет на диске, вытесненные пиксели было бы неоткуда перечитать
+            self.store.put(("tiles", entry.source_key), SpriteTiles.from_image(image), pinned=entry.file_size is None)
+            if self.pixel_cache is not None and entry.file_size is not None:
+                self.pixel_cache.put(entry.source_key, image)
+        return entry
+
+    def _make_entry(self, name, path, category):
+        if self.source is not None and path in self.source:
+            return self.source.entry(name, path, category)
+        return make_entry(name, path, category)
+
+    def add_accessory(self, category, name, path, image=None):
+        """Добавляет в каталог новый файл (например, окрашенный modified_) без пересканирования."""
+        self.accessories.setdefault(category, [])
+        return self._add_entry(category, name, path, image)
+
+    def find(self, category, name):
+        for acc_name, entry in self.accessories.get(category, []):
+            if acc_name == name:
+                return entry
+        return None
+
+    def selection_entry(self, category, name, tint=None):
+        """Запись выбора name с окраской tint (r, g, b) или None, если аксессуара нет.
+
+        modified_ файлы окрашены при сохранении: цвет, который старые пресеты и история
+        хранят рядом с их именем, повторно не применяется.
+        """
+        entry = self.find(category, name)
+        tint = selection_tint(name, tint)
+        if entry is None or tint is None:
+            return entry
+        return entry.tinted(tint)
+
+    def load_tiles(self, entry):
+        """Пиксели файла записи в виде обрезанных тайлов кадров (окраска не применяется)."""
+        key = entry.source_key
+
+        def decode():
+            image = self.pixel_cache.get(key) if self.pixel_cache is not None else None
+            if image is None:
+                image = self._open_image(entry.path).convert("RGBA")
+                if self.pixel_cache is not None:
+                    self.pixel_cache.put(key, image)
+            return SpriteTiles.from_image(image)
+
+        return self.store.get(("tiles", key), decode)
+
+    def load(self, entry):
+        """Возвращает декодированное RGBA-изображение файла записи (окраска не применяется).
+
+        Изображение собирается из тайлов при каждом вызове и каталогом не удерживается.
+        """
+        return self.load_tiles(entry).to_image()
+
+    def _open_image(self, path):
+        if self.source is not None and path in self.source:
+            return self.source.open_image(path)
+        return Image.open(path)
+
+    def resident_bytes(self):
+        """Объём декодированных пикселей ресурсов каталога, находящихся сейчас в хранилище."""
+        return sum(self.store.item_bytes(key) for key in self._tile_keys())
+
+    def _tile_keys(self):
+        entries = list(self.skins)
+        for items in self.accessories.values():
+            entries.extend(entry for _, entry in items)
+        return {("tiles", entry.source_key) for entry in entries}
+
+    def asset_count(self):
+        return len(self.skins) + sum(len(items) for items in self.accessories.values())
+
+    def is_loaded(self, entry):
+        return ("tiles", entry.source_key) in self.store
+
+    def unload(self):
+        self.store.discard(self._tile_keys())
@@ -0,0 +1,320 @@
+"""Экспорт кадров персонажей в атлас текстур для игрового движка.
+
+Кадры листа находит нарезчик (npc_slicer), каждый обрезается по непрозрачным пикселям
+и укладывается алгоритмом MaxRects в атлас со сторонами-степенями двойки. Рядом с
+<имя>.png пишется <имя>.json в формате «hash» TexturePacker: прямоугольники кадров,
+исходные размеры, точки опоры и строки анимаций. Несколько листов (например, пресетов)
+укладываются в один общий атлас; одинаковые кадры хранятся в нём один раз.
+"""
+import os
+import json
+import math
+import hashlib
+
+import numpy as np
+from PIL import Image
+
+from npc_assets import FRAME_CELL
+from npc_compositor import CompositingEngine
+from npc_slicer import alpha_mask, slice_mask
+from npc_writer import atomic_write, image_bytes
+
+ATLAS_FORMAT_VERSION = 1
+
+
+# ------------------------- Кадры листа -------------------------
+class AtlasFrame:
+    """Обрезанный кадр листа.
+
+    box – прямоугольник кадра на листе по нарезчику, trim – прямоугольник непрозрачных
+    пикселей внутри него, cell – ячейка сетки FRAME_CELL, в которой лежит кадр (все
+    (x0, y0, x1, y1) в координатах листа).
+    """
+    __slots__ = ("name", "sprite", "row", "index", "box", "trim", "cell", "image")
+
+    def __init__(self, name, sprite, row, index, box, trim, image, cell_size=FRAME_CELL):
+        self.name = name
+        self.sprite = sprite
+        self.row = row
+        self.index = index
+        self.box = box
+        self.trim = trim
+        self.image = image
+        cell_width, cell_height = cell_size
+        cell_x = (box[0] + box[2]) // 2 // cell_width * cell_width
+        cell_y = (box[1] + box[3]) // 2 // cell_height * cell_height
+        self.cell = (cell_x, cell_y, cell_x + cell_width, cell_y + cell_height)
+
+    @property
+    def size(self):
+        return self.trim[2] - self.trim[0], self.trim[3] - self.trim[1]
+
+    def pivot(self):
+        """Точка опоры – середина нижнего края ячейки – в пикселях обрезанного кадра.
+
+        Листы нарисованы по сетке FRAME_CELL, и ноги персонажа стоят в одной точке
+        каждой ячейки, поэтому при такой опоре кадры разного размера не «прыгают».
+        """
+        return (self.cell[0] + self.cell[2]) / 2 - self.trim[0], self.cell[3] - self.trim[1]
+
+
+def sheet_frames(sprite, image, grid=None):
+    """Кадры листа по строкам анимаций, обрезанные по непрозрачным пикселям.
+
+    grid – сетка кадров (как slice_mask); без неё лист нарезается по альфе.
+    """
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    mask = alpha_mask(image)
+    if grid is None:
+        grid = slice_mask(mask)
+    frames = []
+    for row, boxes in enumerate(grid):
+        for index, box in enumerate(boxes):
+            x0, y0, x1, y1 = box
+            cell = mask[y0:y1, x0:x1]
+            rows = np.flatnonzero(cell.any(axis=1))
+            if not len(rows):
+                continue
+            columns = np.flatnonzero(cell.any(axis=0))
+            trim = (x0 + int(columns[0]), y0 + int(rows[0]), x0 + int(columns[-1]) + 1, y0 + int(rows[-1]) + 1)
+            frames.append(AtlasFrame(f"{sprite}/{row}_{index}", sprite, row, index, box, trim, image.crop(trim)))
+    return frames
+
+
+# ------------------------- Упаковка MaxRects -------------------------
+def next_power_of_two(value):
+    return 1 << max(0, math.ceil(math.log2(max(1, value))))
+
+
+def _contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1]
+            and outer[0] + outer[2] >= inner[0] + inner[2] and outer[1] + outer[3] >= inner[1] + inner[3])
+
+
+class MaxRectsPacker:
+    """Упаковщик MaxRects с эвристикой Best Short Side Fit, без поворота кадров.
+
+    Свободное место – список максимальных прямоугольников (x, y, w, h); кадр ставится
+    туда, где меньше всего остаётся по короткой стороне.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.free = [(0, 0, width, height)]
+
+    def insert(self, width, height):
+        """Позиция (x, y) для прямоугольника или None, если он не помещается."""
+        best = None
+        best_fit = None
+        for x, y, free_width, free_height in self.free:
+            if width <= free_width and height <= free_height:
+                left_x, left_y = free_width - width, free_height - height
+                fit = (min(left_x, left_y), max(left_x, left_y))
+                if best_fit is None or fit < best_fit:
+                    best, best_fit = (x, y), fit
+        if best is not None:
+            self._place((best[0], best[1], width, height))
+        return best
+
+    def _place(self, used):
+        ux, uy, uw, uh = used
+        kept = []
+        split = []
+        for free in self.free:
+            x, y, w, h = free
+            if ux >= x + w or ux + uw <= x or uy >= y + h or uy + uh <= y:
+                kept.append(free)
+                continue
+            # Остаток свободного прямоугольника вокруг занятого – до четырёх полос
+            if ux > x:
+                split.append((x, y, ux - x, h))
+            if ux + uw < x + w:
+                split.append((ux + uw, y, x + w - ux - uw, h))
+            if uy > y:
+                split.append((x, y, w, uy - y))
+            if uy + uh < y + h:
+                split.append((x, uy + uh, w, y + h - uy - uh))
+        # Полосы, целиком лежащие в других свободных прямоугольниках, не нужны. Нетронутые
+        # прямоугольники друг в друга не вложены и в полосы (части прежних) тоже не попадают.
+        split = [rect for i, rect in enumerate(split)
+                 if not any(_contains(other, rect) for other in kept)
+                 and not any(_contains(other, rect) and (other != rect or j < i)
+                             for j, other in enumerate(split) if j != i)]
+        self.free = kept + split
+
+
+def pack_rects(sizes, padding=1, max_size=4096):
+    """Раскладывает прямоугольники в атлас наименьшей найденной площади.
+
+    Стороны атласа – степени двойки: начиная с наименьшего размера, вмещающего
+    суммарную площадь, растёт меньшая сторона, пока всё не поместится. Между кадрами
+    остаётся padding пикселей. Возвращает ((ширина, высота), позиции в порядке sizes).
+    """
+    if not sizes:
+        return (1, 1), []
+    padded = [(w + padding, h + padding) for w, h in sizes]
+    area = sum(w * h for w, h in padded)
+    width = max(next_power_of_two(max(w for w, _ in sizes)), next_power_of_two(math.isqrt(area)))
+    height = max(next_power_of_two(max(h for _, h in sizes)), next_power_of_two(math.ceil(area / width)))
+    # Крупные кадры первыми: мелкие потом заполняют остатки
+    order = sorted(range(len(sizes)), key=lambda i: (max(padded[i]), padded[i][0] * padded[i][1]), reverse=True)
+    while width <= max_size and height <= max_size:
+        # Отступ нужен только между кадрами, поэтому корзина шире атласа на padding
+        packer = MaxRectsPacker(width + padding, height + padding)
+        positions = [None] * len(sizes)
+        for i in order:
+            position = packer.insert(*padded[i])
+            if position is None:
+                break
+            positions[i] = position
+        else:
+            return (width, height), positions
+        if width <= height:
+            width *= 2
+        else:
+            height *= 2
+    raise ValueError(f"Кадры не помещаются в атлас {max_size}x{max_size}.")
+
+
+# ------------------------- Атлас -------------------------
+def build_atlas(sheets, image_name, padding=1, max_size=4096):
+    """Упаковывает кадры листов в один атлас.
+
+    sheets – список (имя, лист) или (имя, лист, сетка кадров). Возвращает
+    (изображение атласа, данные JSON). Имена кадров – "<имя листа>/<строка>_<кадр>",
+    анимации – "<имя листа>/row_<строка>" со списком кадров по порядку.
+    """
+    frames = []
+    sheet_sizes = {}
+    for sheet in sheets:
+        name, image = sheet[0], sheet[1]
+        if name in sheet_sizes:
+            raise ValueError(f"Лист '{name}' встречается дважды.")
+        sheet_sizes[name] = image.size
+        frames.extend(sheet_frames(name, image, sheet[2] if len(sheet) > 2 else None))
+
+    # Одинаковые кадры (повторы внутри анимации, общие позы) занимают одно место
+    unique = {}
+    slots = []
+    for frame in frames:
+        digest = (frame.size, hashlib.sha1(frame.image.tobytes()).digest())
+        slots.append(unique.setdefault(digest, len(unique)))
+    unique_frames = {}
+    for frame, slot in zip(frames, slots):
+        unique_frames.setdefault(slot, frame)
+    size, positions = pack_rects([unique_frames[slot].size for slot in range(len(unique))], padding, max_size)
+
+    atlas = Image.new("RGBA", size, (0, 0, 0, 0))
+    for slot, position in enumerate(positions):
+        atlas.paste(unique_frames[slot].image, position)
+
+    frames_data = {}
+    animations = {}
+    for frame, slot in zip(frames, slots):
+        x, y = positions[slot]
+        width, height = frame.size
+        pivot_x, pivot_y = frame.pivot()
+        cell_x, cell_y = frame.cell[:2]
+        frames_data[frame.name] = {
+            "frame": {"x": x, "y": y, "w": width, "h": height},
+            "rotated": False,
+            "trimmed": True,
+            "spriteSourceSize": {"x": frame.trim[0] - cell_x, "y": frame.trim[1] - cell_y, "w": width, "h": height},
+            "sourceSize": {"w": frame.cell[2] - cell_x, "h": frame.cell[3] - cell_y},
+            "sourceRect": {"x": frame.trim[0], "y": frame.trim[1], "w": width, "h": height},
+            "pivot": {"x": round(pivot_x / width, 4), "y": round(pivot_y / height, 4)},
+            "pivotPixels": {"x": pivot_x, "y": pivot_y},
+            "sheet": frame.sprite,
+            "row": frame.row,
+            "index": frame.index,
+        }
+        animations.setdefault(f"{frame.sprite}/row_{frame.row}", []).append(frame.name)
+
+    data = {
+        "frames": frames_data,
+        "animations": animations,
+        "sheets": {name: {"w": w, "h": h} for name, (w, h) in sheet_sizes.items()},
+        "meta": {
+            "app": "Sprite Customizer",
+            "version": ATLAS_FORMAT_VERSION,
+            "image": image_name,
+            "format": "RGBA8888",
+            "size": {"w": size[0], "h": size[1]},
+            "scale": "1",
+            "padding": padding,
+            "cell": {"w": FRAME_CELL[0], "h": FRAME_CELL[1]},
+        },
+    }
+    return atlas, data
+
+
+def atlas_paths(path):
+    """Пути (PNG, JSON) атласа по пути к PNG или имени без расширения."""
+    base = os.path.splitext(path)[0]
+    return base + ".png", base + ".json"
+
+
+def export_atlas(path, sheets, padding=1, max_size=4096):
+    """Строит атлас и пишет PNG и JSON рядом друг с другом; возвращает данные JSON."""
+    png_path, json_path = atlas_paths(path)
+    atlas, data = build_atlas(sheets, os.path.basename(png_path), padding, max_size)
+    atomic_write(png_path, image_bytes(atlas))
+    atomic_write(json_path, json.dumps(data, ensure_ascii=False, indent=1).encode("utf-8"))
+    return data
+
+
+# ------------------------- Пресеты -------------------------
+def parse_color(name):
+    """'#rrggbb' (как пишет QColor.name()) -> (r, g, b)."""
+    name = name.lstrip("#")
+    return int(name[0:2], 16), int(name[2:4], 16), int(name[4:6], 16)
+
+
+def preset_selection(catalog, config):
+    """Скин и выбранные аксессуары пресета так же, как их восстанавливает интерфейс."""
+    skins = catalog.skins
+    skin_index = config.get('current_skin_index', 0)
+    skin = skins[skin_index] if 0 <= skin_index < len(skins) else None
+    colors = config.get('colors', {})
+    selected_accessories = {}
+    for category, names in config.get('selected_accessories', {}).items():
+        for name in names:
+            entry = catalog.selection_entry(category, name, parse_color(colors[name]) if name in colors else None)
+            if entry is None:
+                continue
+            selected_accessories.setdefault(category, []).append((name, entry))
+    return skin, selected_accessories
+
+
+def load_preset(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def is_saved_preset(file_name):
+    """Пресет пользователя, а не автосохранение tempbackup_* при закрытии окна."""
+    return file_name.endswith(".json") and not file_name.startswith("tempbackup_")
+
+
+def render_presets(presets, get_catalog):
+    """Листы пресетов для build_atlas: список (имя, изображение).
+
+    presets – список (имя, конфигурация); get_catalog(пол) возвращает каталог ресурсов
+    или None. Пресеты неизвестного пола и без скина пропускаются.
+    """
+    engines = {}
+    sheets = []
+    for name, config in presets:
+        gender = config.get('gender', 'Man')
+        catalog = get_catalog(gender)
+        if catalog is None:
+            continue
+        if gender not in engines:
+            engines[gender] = CompositingEngine(catalog.load_tiles, catalog.layers_order, catalog.store)
+        skin, selected_accessories = preset_selection(catalog, config)
+        if skin is None:
+            continue
+        sheets.append((name, engines[gender].compose(skin, selected_accessories)))
+    return sheets
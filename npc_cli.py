@@ -0,0 +1,226 @@
+"""Консольный генератор датасетов без PyQt5.
+
+    python -m npc_custom generate --gender Woman --count 50000 --out datasets/
+    python npc_cli.py generate --source Construct.zip --workers 8 --seed 42
+    python npc_cli.py generate --seed 42 --start 1234 --count 1   # повторить одну выборку
+    python npc_cli.py atlas presets/ --out exports/npcs.png       # пресеты в общий атлас
+"""
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+from npc_assets import (
+    BASE_DIR, GENDERS, AssetCatalog, AssetStore, PixelCache, find_default_archive, extract_archive, can_read_directly, ArchiveError
+)
+from npc_atlas import export_atlas, load_preset, is_saved_preset, render_presets
+from npc_generation import GenerationEngine
+from npc_dataset import OUTPUT_FORMATS
+
+# Подкоманды; npc_custom передаёт их сюда, не запуская интерфейс
+COMMANDS = ("generate", "atlas")
+
+
+def resolve_source(source, extract_path):
+    """Возвращает папку, внутри которой лежит Construct/<пол>, или сам архив.
+
+    source – распакованная папка (сама Construct или её родитель) либо архив. zip и tar
+    читаются на месте; остальные архивы распаковываются в extract_path.
+    """
+    if os.path.isdir(source):
+        if os.path.basename(os.path.normpath(source)) == "Construct":
+            return os.path.dirname(os.path.normpath(source))
+        return source
+    if not os.path.exists(source):
+        raise ArchiveError(f"Источник ресурсов '{source}' не найден.")
+    if can_read_directly(source):
+        return source
+    # Повторный вызов распаковывает только изменившиеся в архиве файлы
+    extract_archive(source, extract_path)
+    return extract_path
+
+
+def positive_int(value):
+    """Тип argparse: целое больше нуля (размеры чанков и числа потоков)."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"нужно целое число больше нуля: '{value}'")
+    return number
+
+
+def add_source_arguments(parser):
+    parser.add_argument("--source", default=None,
+                        help="Архив ресурсов или распакованная папка (по умолчанию extracted_sprites или Construct.*).")
+    parser.add_argument("--extract-path", default=os.path.join(BASE_DIR, "extracted_sprites"),
+                        help="Куда распаковывать архив tar.gz, rar или 7z (zip и tar читаются без распаковки).")
+    parser.add_argument("--modified-path", default=os.path.join(BASE_DIR, "modified_accessories"))
+    parser.add_argument("--cache-dir", default=os.path.join(BASE_DIR, "sprite_cache"),
+                        help="Кэш декодированных пикселей; пустая строка отключает кэш.")
+    parser.add_argument("--memory-budget", type=int, default=0, metavar="МБ",
+                        help="Бюджет памяти декодированных ресурсов (на процесс); 0 – без ограничения.")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="npc_custom", description="Sprite Customizer без графического интерфейса.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate = commands.add_parser("generate", help="Сгенерировать датасет случайных персонажей.")
+    generate.add_argument("--gender", choices=GENDERS, default="Man")
+    generate.add_argument("--count", type=positive_int, default=100, help="Количество изображений.")
+    generate.add_argument("--out", default=os.path.join(BASE_DIR, "datasets"), help="Папка для результатов.")
+    add_source_arguments(generate)
+    generate.add_argument("--workers", type=positive_int, default=os.cpu_count() or 1)
+    generate.add_argument("--chunk-size", type=positive_int, default=16)
+    generate.add_argument("--format", choices=OUTPUT_FORMATS, default="png",
+                          help="png – отдельные файлы, tar – шарды, array – один RGBA-файл для np.memmap.")
+    generate.add_argument("--shard-size", type=positive_int, default=1024, help="Изображений в одном tar-шарде.")
+    generate.add_argument("--encoders", type=positive_int, default=2, help="Потоков PNG-кодирования в каждом процессе.")
+    generate.add_argument("--compress-level", type=int, choices=range(10), default=6, metavar="0-9",
+                          help="Уровень zlib для PNG: меньше – быстрее и крупнее файлы.")
+    generate.add_argument("--seed", type=int, default=None,
+                          help="Зерно выборки; без него выбирается случайное и печатается.")
+    generate.add_argument("--start", type=int, default=0,
+                          help="Номер первой выборки: (зерно, номер) однозначно задаёт персонажа.")
+    generate.add_argument("--quiet", action="store_true")
+
+    atlas = commands.add_parser("atlas", help="Собрать кадры пресетов в общий атлас текстур с описанием в JSON.")
+    atlas.add_argument("presets", nargs="+", help="Файлы пресетов .json или папки с ними.")
+    atlas.add_argument("--out", default=os.path.join(BASE_DIR, "exports", "atlas.png"),
+                       help="PNG атласа; JSON пишется рядом с тем же именем.")
+    add_source_arguments(atlas)
+    atlas.add_argument("--padding", type=int, default=1, help="Пикселей между кадрами.")
+    atlas.add_argument("--max-size", type=int, default=4096, help="Наибольшая сторона атласа.")
+    atlas.add_argument("--quiet", action="store_true")
+    return parser
+
+
+def memory_budget(args):
+    return args.memory_budget * 1024 * 1024 if args.memory_budget > 0 else None
+
+
+def open_source(args):
+    """Папка или архив ресурсов по аргументам --source/--extract-path; None, если не найдено."""
+    source = args.source
+    if source is None:
+        source = args.extract_path if os.path.isdir(args.extract_path) else find_default_archive()
+    if not source:
+        print("Ресурсы не найдены: укажите --source.", file=sys.stderr)
+        return None
+    try:
+        return resolve_source(source, args.extract_path)
+    except ArchiveError as e:
+        print(e, file=sys.stderr)
+        return None
+
+
+def run_generate(args):
+    extract_path = open_source(args)
+    if extract_path is None:
+        return 2
+
+    engine = GenerationEngine(extract_path, args.modified_path, args.gender, args.out,
+                              cache_dir=args.cache_dir or None, workers=args.workers,
+                              chunk_size=args.chunk_size, encoders=args.encoders,
+                              compress_level=args.compress_level, output_format=args.format,
+                              shard_size=args.shard_size, memory_budget=memory_budget(args))
+    tasks = engine.plan(args.count, args.seed, args.start)
+    if not engine.planned:
+        if engine.sampler.combinations:
+            print(f"Номер {args.start} вне пространства из {engine.sampler.combinations} комбинаций.", file=sys.stderr)
+        else:
+            print(f"В '{extract_path}' нет скинов для пола {args.gender}.", file=sys.stderr)
+        return 1
+    if not args.quiet:
+        if engine.planned < args.count:
+            print(f"Уникальных комбинаций меньше запрошенного: будет {engine.planned}.", file=sys.stderr)
+        print(f"Зерно: {engine.seed}", file=sys.stderr)
+
+    start = time.perf_counter()
+
+    def progress(done, total):
+        if not args.quiet:
+            print(f"\r{done}/{total}", end="", file=sys.stderr, flush=True)
+
+    try:
+        done = engine.run(tasks, progress)
+    except KeyboardInterrupt:
+        engine.cancel()
+        print("\nПрервано.", file=sys.stderr)
+        return 130
+    elapsed = time.perf_counter() - start
+    if not args.quiet:
+        print(f"\nСгенерировано {done} изображений за {elapsed:.1f} с "
+              f"({done / elapsed if elapsed else 0:.1f} изобр./с) в {args.out}", file=sys.stderr)
+        print(f"Индекс: {engine.manifest}", file=sys.stderr)
+        print(engine.stage_report(), file=sys.stderr)
+    return 0
+
+
+def preset_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if is_saved_preset(name))
+        else:
+            files.append(path)
+    return files
+
+
+def run_atlas(args):
+    presets = []
+    for path in preset_files(args.presets):
+        try:
+            presets.append((os.path.splitext(os.path.basename(path))[0], load_preset(path)))
+        except (OSError, ValueError) as e:
+            print(f"Пресет '{path}' пропущен: {e}", file=sys.stderr)
+    if not presets:
+        print("Нет пресетов для атласа.", file=sys.stderr)
+        return 1
+    extract_path = open_source(args)
+    if extract_path is None:
+        return 2
+
+    pixel_cache = PixelCache(args.cache_dir) if args.cache_dir else None
+    store = AssetStore(memory_budget(args))
+    catalogs = {}
+
+    def get_catalog(gender):
+        if gender not in GENDERS:
+            return None
+        if gender not in catalogs:
+            catalogs[gender] = AssetCatalog(extract_path, args.modified_path, gender, pixel_cache=pixel_cache,
+                                            store=store).scan()
+        return catalogs[gender]
+
+    start = time.perf_counter()
+    sheets = render_presets(presets, get_catalog)
+    if len(sheets) < len(presets) and not args.quiet:
+        print(f"Пропущено пресетов без скина или с неизвестным полом: {len(presets) - len(sheets)}.", file=sys.stderr)
+    try:
+        data = export_atlas(args.out, sheets, args.padding, args.max_size)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if not args.quiet:
+        size = data["meta"]["size"]
+        print(f"Атлас {size['w']}x{size['h']}: {len(sheets)} пресетов, {len(data['frames'])} кадров "
+              f"за {time.perf_counter() - start:.1f} с -> {args.out}", file=sys.stderr)
+        print(f"Ресурсы в памяти: {store.report()}", file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "generate":
+        return run_generate(args)
+    if args.command == "atlas":
+        return run_atlas(args)
+    return 2
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,355 @@
+import numpy as np
+from PIL import Image
+
+from npc_assets import LAYERS_ORDER, AssetStore, LRUCache, SpriteTiles, shared_image
+
+
+# ------------------------- Окраска -------------------------
+def tint_lut(tint):
+    """Таблицы (3, 256) умножения каналов R, G, B на цвет tint, как в ImageChops.multiply."""
+    values = np.arange(256, dtype=np.uint32)
+    return np.array([values * int(component) // 255 for component in tint[:3]], dtype=np.uint8)
+
+
+def tint_pixels(pixels, tint):
+    """Умножает RGB массива (..., 4) uint8 на цвет; альфа не меняется."""
+    lut = tint_lut(tint)
+    out = pixels.copy()
+    for channel in range(3):
+        out[..., channel] = lut[channel].take(pixels[..., channel])
+    return out
+
+
+def tint_image(image, tint):
+    """Окрашенная копия изображения – для "запекания" цвета в файл."""
+    image = image if image.mode == "RGBA" else image.convert("RGBA")
+    return shared_image(tint_pixels(np.asarray(image), tint), image.size)
+
+
+# ------------------------- Разреженные premultiplied-слои -------------------------
+class PixelLayer:
+    """Слой в виде непрозрачных пикселей холста.
+
+    index – отсортированные плоские индексы пикселей (y * width + x) с ненулевой альфой,
+    color – их цвет в premultiplied-виде (float32, 0..1, shape (K, 4)).
+    Прозрачные пиксели не хранятся и не участвуют в наложении.
+    """
+    __slots__ = ("size", "index", "color")
+
+    def __init__(self, size, index, color):
+        self.size = size
+        self.index = index
+        self.color = color
+
+    @classmethod
+    def from_image(cls, image, size=None, tint=None):
+        """Строит слой из RGBA-изображения; size – размер холста (лист прикладывается к (0, 0)).
+
+        tint – цвет (r, g, b), на который умножаются только непрозрачные пиксели.
+        """
+        image = image if image.mode == "RGBA" else image.convert("RGBA")
+        size = size or image.size
+        pixels = np.asarray(image, dtype=np.uint8)
+        if image.size != size:
+            width, height = size
+            canvas = np.zeros((height, width, 4), dtype=np.uint8)
+            h = min(height, image.height)
+            w = min(width, image.width)
+            canvas[:h, :w] = pixels[:h, :w]
+            pixels = canvas
+        pixels = pixels.reshape(-1, 4)
+        index = np.flatnonzero(pixels[:, 3]).astype(np.int32)
+        return cls.from_opaque(size, index, pixels[index], tint)
+
+    @classmethod
+    def from_tiles(cls, tiles, size=None, tint=None):
+        """Строит слой из SpriteTiles, не восстанавливая полный лист: читаются только тайлы."""
+        size = size or tiles.size
+        width, height = size
+        indices = []
+        colors = []
+        for x, y, tile in tiles.tiles:
+            tile = tile[:max(0, height - y), :max(0, width - x)]
+            ys, xs = np.nonzero(tile[:, :, 3])
+            indices.append((ys + y) * width + (xs + x))
+            colors.append(tile[ys, xs])
+        if not indices:
+            return cls.from_opaque(size, np.zeros(0, dtype=np.int32), np.zeros((0, 4), dtype=np.uint8), tint)
+        index = np.concatenate(indices).astype(np.int32)
+        opaque = np.concatenate(colors)
+        # Тайлы идут по ячейкам, а индекс слоя упорядочен по строкам холста
+        order = np.argsort(index, kind="stable")
+        return cls.from_opaque(size, index[order], opaque[order], tint)
+
+    @classmethod
+    def from_opaque(cls, size, index, opaque, tint=None):
+        """index – индексы пикселей с ненулевой альфой, opaque – их RGBA uint8."""
+        if tint is not None:
+            opaque = tint_pixels(opaque, tint)
+        color = opaque.astype(np.float32)
+        color *= 1.0 / 255.0
+        color[:, :3] *= color[:, 3:4]
+        return cls(size, index, color)
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.color.nbytes
+
+    def to_array(self):
+        """Возвращает обычный (не premultiplied) RGBA uint8 массив формы (height, width, 4)."""
+        width, height = self.size
+        return unpremultiply(self.index, self.color, width * height).reshape(height, width, 4)
+
+    def to_image(self):
+        return shared_image(self.to_array(), self.size)
+
+
+def union_index(size, layers):
+    """Объединение покрытых пикселей слоёв и карта "индекс пикселя -> позиция в объединении"."""
+    width, height = size
+    pixel_count = width * height
+    mask = np.zeros(pixel_count, dtype=bool)
+    for layer in layers:
+        mask[layer.index] = True
+    index = np.flatnonzero(mask).astype(np.int32)
+    position = np.empty(pixel_count, dtype=np.int32)
+    position[index] = np.arange(len(index), dtype=np.int32)
+    return index, position
+
+
+def unpremultiply(index, color, pixel_count):
+    straight = color.copy()
+    straight[:, :3] /= straight[:, 3:4]
+    straight *= 255.0
+    straight += 0.5
+    out = np.zeros((pixel_count, 4), dtype=np.uint8)
+    out[index] = straight
+    return out
+
+
+def over(bottom, top):
+    """Оператор "over": top поверх bottom. None – пустой слой."""
+    if bottom is None:
+        return top
+    if top is None:
+        return bottom
+    index, position = union_index(bottom.size, (bottom, top))
+    color = np.zeros((len(index), 4), dtype=np.float32)
+    color[position.take(bottom.index)] = bottom.color
+    pos = position.take(top.index)
+    current = color.take(pos, axis=0)
+    current *= 1.0 - top.color[:, 3:4]
+    current += top.color
+    color[pos] = current
+    return PixelLayer(bottom.size, index, color)
+
+
+def under(top, bottom):
+    """Оператор "under": bottom подкладывается под уже собранный top."""
+    return over(bottom, top)
+
+
+def composite_stack(size, operations):
+    """Накладывает весь стек за один проход по общему холсту.
+
+    operations – последовательность пар ("over" | "under", PixelLayer | None). Холст хранится
+    только для пикселей, покрытых хотя бы одним слоем, в premultiplied float32.
+    """
+    width, height = size
+    pixel_count = width * height
+    operations = [(op, layer) for op, layer in operations if layer is not None]
+    if not operations:
+        return Image.new("RGBA", size)
+    index, position = union_index(size, [layer for _, layer in operations])
+    canvas = np.zeros((len(index), 4), dtype=np.float32)
+    for op, layer in operations:
+        pos = position.take(layer.index)
+        current = canvas.take(pos, axis=0)
+        if op == "under":
+            current += layer.color * (1.0 - current[:, 3:4])
+        else:
+            current *= 1.0 - layer.color[:, 3:4]
+            current += layer.color
+        canvas[pos] = current
+    pixels = unpremultiply(index, canvas, pixel_count)
+    return shared_image(pixels.reshape(height, width, 4), size)
+
+
+# ------------------------- Движок наложения -------------------------
+class CompositingEngine:
+    """Общий движок наложения слоёв для интерфейса и GenerationWorker.
+
+    Листы переводятся в PixelLayer и хранятся в store (AssetStore) по ключу записи
+    каталога; ключ окрашенной записи включает цвет, так что хранится слой для каждой
+    пары (ресурс, цвет). Вытесненный по бюджету памяти слой строится заново.
+    """
+
+    def __init__(self, load, layers_order=LAYERS_ORDER, store=None):
+        self.load = load
+        self.layers_order = layers_order
+        self.store = store if store is not None else AssetStore()
+
+    def canvas_size(self, skin):
+        return self.load(skin).size
+
+    def layer(self, entry, size):
+        def build():
+            # load может отдавать как изображение, так и SpriteTiles (AssetCatalog.load_tiles)
+            source = self.load(entry)
+            if isinstance(source, SpriteTiles):
+                return PixelLayer.from_tiles(source, size, entry.tint)
+            return PixelLayer.from_image(source, size, entry.tint)
+
+        return self.store.get(("layer", entry.key, size), build)
+
+    def operations(self, skin, selected_accessories, size):
+        operations = [("over", self.layer(skin, size))]
+        for layer_name in self.layers_order:
+            if layer_name == "Skin":
+                continue
+            # Каждый элемент "Back Layers" подкладывается под уже собранное изображение
+            op = "under" if layer_name == "Back Layers" else "over"
+            for _, entry in selected_accessories.get(layer_name, []):
+                operations.append((op, self.layer(entry, size)))
+        return operations
+
+    def compose(self, skin, selected_accessories):
+        """Собирает персонажа целиком; selected_accessories – {категория: [(имя, запись), ...]}."""
+        if skin is None:
+            return None
+        size = self.canvas_size(skin)
+        return composite_stack(size, self.operations(skin, selected_accessories, size))
+
+    def cached_bytes(self):
+        """Объём слоёв в хранилище (всех движков, если хранилище общее)."""
+        return self.store.kind_bytes("layer")
+
+    def clear(self):
+        self.store.clear("layer")
+
+
+# ------------------------- Инкрементальный композитор -------------------------
+def slot_items(layer, items):
+    """Элементы слота снизу вверх.
+
+    Каждый следующий элемент "Back Layers" подкладывается под уже собранное изображение,
+    поэтому внутри этого слота порядок обратный порядку выбора.
+    """
+    items = list(items)
+    if layer == "Back Layers":
+        items.reverse()
+    return items
+
+
+class LayerCompositor:
+    """Собирает персонажа из слотов layers_order и кэширует частичные стеки.
+
+    Для каждого слота хранятся композиция его элементов, композиция всех слотов ниже
+    и композиция всех слотов выше. При переключении одного аксессуара пересобирается
+    только изменившийся слот, а итог получается из готовых "низа" и "верха" – число
+    наложений не зависит от количества выбранных слоёв.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.slots = list(engine.layers_order)
+        self.reset()
+
+    def reset(self):
+        self._size = None
+        self._slot_keys = [None] * len(self.slots)
+        self._slot_layers = [None] * len(self.slots)
+        self._below = {}
+        self._above = {}
+        self._result = None
+
+    def compose(self, skin, selected_accessories):
+        """skin – запись скина, selected_accessories – {категория: [(имя, запись), ...]}."""
+        if skin is None:
+            return None
+        # Размер холста задаёт скин; листы другого размера прикладываются к левому верхнему углу
+        size = self.engine.canvas_size(skin)
+        if size != self._size:
+            self.reset()
+            self._size = size
+        changed = []
+        for index, layer in enumerate(self.slots):
+            if layer == "Skin":
+                entries = [skin]
+            else:
+                entries = [entry for _, entry in slot_items(layer, selected_accessories.get(layer, []))]
+            keys = tuple(entry.key for entry in entries)
+            if keys != self._slot_keys[index]:
+                self._slot_keys[index] = keys
+                self._slot_layers[index] = self._compose_slot(entries)
+                changed.append(index)
+
+        if not changed and self._result is not None:
+            return self._result
+
+        for index in changed:
+            # Кэш "ниже" устарел для слотов выше изменённого, кэш "выше" – для слотов ниже
+            self._below = {i: layer for i, layer in self._below.items() if i <= index}
+            self._above = {i: layer for i, layer in self._above.items() if i >= index}
+
+        pivot = changed[-1] if changed else len(self.slots) - 1
+        self._result = composite_stack(size, [
+            ("over", self.below(pivot)),
+            ("over", self._slot_layers[pivot]),
+            ("over", self.above(pivot)),
+        ])
+        return self._result
+
+    def _compose_slot(self, entries):
+        layer = None
+        for entry in entries:
+            layer = over(layer, self.engine.layer(entry, self._size))
+        return layer
+
+    def below(self, index):
+        """Композиция всех слотов под index (None, если там ничего нет)."""
+        if index == 0:
+            return None
+        if index not in self._below:
+            start = index - 1
+            while start > 0 and start not in self._below:
+                start -= 1
+            layer = self._below.get(start)
+            for i in range(start, index):
+                layer = over(layer, self._slot_layers[i])
+                self._below[i + 1] = layer
+        return self._below[index]
+
+    def above(self, index):
+        """Композиция всех слотов над index (None, если там ничего нет)."""
+        last = len(self.slots) - 1
+        if index == last:
+            return None
+        if index not in self._above:
+            start = index + 1
+            while start < last and start not in self._above:
+                start += 1
+            layer = self._above.get(start)
+            for i in range(start, index, -1):
+                layer = over(self._slot_layers[i], layer)
+                self._above[i - 1] = layer
+        return self._above[index]
+
+
+# ------------------------- Кэш готовых композиций -------------------------
+class RenderCache(LRUCache):
+    """LRU-кэш отрисованных состояний персонажа с ограничением по памяти.
+
+    Значение хранится вместе с его оценкой размера в байтах (put(key, value, nbytes));
+    при превышении max_bytes вытесняются давно не использованные записи. Счётчики
+    hits/misses нужны для подбора бюджета.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        super().__init__(max_bytes)
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return (f"{len(self)} состояний, {self._bytes / (1024 * 1024):.1f} из "
+                f"{self.max_bytes / (1024 * 1024):.0f} МБ; попаданий {self.hits}, промахов {self.misses} ({rate:.0%})")
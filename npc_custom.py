@@ -1,41 +1,45 @@
 import sys
 import os
-import zipfile
+
+# Консольные команды (python -m npc_custom generate|atlas ...) запускаются до импорта PyQt5 и qasync
+if __name__ == "__main__" and len(sys.argv) > 1:
+    from npc_cli import COMMANDS
+    if sys.argv[1] in COMMANDS:
+        import runpy
+        runpy.run_module("npc_cli", run_name="__main__", alter_sys=True)
+        sys.exit(0)
+
 import random
 import subprocess  # Для открытия файлов в проводнике
 import json
 import uuid  # Для генерации уникальных имен файлов
 import asyncio
 import time
+import multiprocessing
 
-from PIL import Image, ImageQt, ImageEnhance, ImageOps, ImageChops
+from PIL import Image, ImageQt, ImageEnhance, ImageOps
 from PyQt5.QtWidgets import (
-    QApplication, QWidget, QLabel, QPushButton, QFileDialog, QListWidget, QListWidgetItem,
+    QApplication, QWidget, QLabel, QPushButton, QFileDialog, QListWidget, QListWidgetItem, QListView,
     QHBoxLayout, QVBoxLayout, QScrollArea, QComboBox, QSplitter, QColorDialog, QInputDialog,
-    QSizePolicy, QFrame, QToolButton, QMenu, QAction, QMessageBox, QProgressBar, QDialog, QSpinBox
+    QSizePolicy, QFrame, QToolButton, QMenu, QAction, QMessageBox, QProgressBar, QDialog, QSpinBox,
+    QProgressDialog
 )
-from PyQt5.QtGui import QPixmap, QIcon, QImage, QFont, QColor
-from PyQt5.QtCore import Qt, QSettings, QSize, QTimer, QThread, pyqtSignal
+from PyQt5.QtGui import QPixmap, QIcon, QFont, QColor, QPainter
+from PyQt5.QtCore import Qt, QSettings, QSize, QRect, QTimer, QThread, pyqtSignal, QAbstractListModel, QModelIndex
 
 from qasync import QEventLoop, asyncSlot
 
-# Определение базовой директории: если собрано в EXE – рядом с EXE, иначе рядом со скриптом.
-def get_base_dir():
-    if getattr(sys, 'frozen', False):
-        return os.path.dirname(sys.executable)
-    else:
-        return os.path.dirname(os.path.abspath(__file__))
-
-BASE_DIR = get_base_dir()
-
-def find_default_archive():
-    """Ищет в BASE_DIR архив с именем Construct с поддерживаемым расширением."""
-    allowed_ext = [".zip", ".tar", ".tgz", ".tar.gz", ".rar", ".7z"]
-    for ext in allowed_ext:
-        candidate = os.path.join(BASE_DIR, "Construct" + ext)
-        if os.path.exists(candidate):
-            return candidate
-    return ""  # Если не найден
+from npc_assets import (
+    AssetCatalog, AssetStore, LRUCache, ArchiveSource, ArchiveError, PixelCache, ThumbnailAtlas, GENDERS,
+    LAYERS_ORDER, BASE_DIR, MODIFIED_PREFIX, selection_tint, find_default_archive, extract_archive,
+    can_read_directly, read_extract_manifest
+)
+from npc_compositor import CompositingEngine, LayerCompositor, RenderCache, tint_image
+from npc_slicer import slice_sprite_sheet, crop_frames, center_frames, OccupancyMasks
+from npc_generation import GenerationEngine, CharacterSampler
+from npc_writer import WriteService
+from npc_atlas import build_atlas, atlas_paths, load_preset, is_saved_preset, render_presets
+from npc_qtimage import to_pixmap
 
 # ------------------------- Асинхронные диалоги -------------------------
 async def async_get_open_file_name(parent, caption, directory, filter):
@@ -70,7 +74,8 @@ async def async_get_text(parent, title, label):
 # -------------------- Рабочие классы --------------------
 from PyQt5.QtCore import QObject
 class ExtractionWorker(QObject):
-    finished = pyqtSignal()
+    progress = pyqtSignal('qint64', 'qint64')
+    finished = pyqtSignal(int)
     error = pyqtSignal(str)
     
     def __init__(self, archive_path, extract_path):
@@ -80,41 +85,8 @@ class ExtractionWorker(QObject):
 
     def run(self):
         try:
-            if not os.path.exists(self.extract_path):
-                os.makedirs(self.extract_path, exist_ok=True)
-            ext = os.path.splitext(self.archive_path)[1].lower()
-            if ext == ".zip":
-                with zipfile.ZipFile(self.archive_path, 'r') as archive:
-                    archive.extractall(self.extract_path)
-            elif ext in [".tar", ".tgz", ".tar.gz"]:
-                import tarfile
-                with tarfile.open(self.archive_path, 'r:*') as archive:
-                    archive.extractall(self.extract_path)
-            elif ext == ".rar":
-                try:
-                    import rarfile
-                    with rarfile.RarFile(self.archive_path) as archive:
-                        archive.extractall(self.extract_path)
-                except ImportError:
-                    self.error.emit("Модуль rarfile не установлен. Установите его (pip install rarfile).")
-                    return
-                except Exception as e:
-                    self.error.emit(f"Не удалось открыть RAR архив: {e}")
-                    return
-            elif ext == ".7z":
-                try:
-                    import py7zr
-                    with py7zr.SevenZipFile(self.archive_path, mode='r') as archive:
-                        archive.extractall(path=self.extract_path)
-                except ImportError:
-                    self.error.emit("Модуль py7zr не установлен. Установите его (pip install py7zr).")
-                    return
-                except Exception as e:
-                    self.error.emit(f"Ошибка при открытии 7z архива: {e}")
-                    return
-            else:
-                self.error.emit(f"Формат архива '{ext}' не поддерживается.")
-                return
+            # Распаковываются только изменившиеся со времени прошлой распаковки файлы
+            changed = extract_archive(self.archive_path, self.extract_path, self.progress.emit)
 
             # Создаём папки modified_accessories и presets в BASE_DIR
             modified_path = os.path.join(BASE_DIR, "modified_accessories")
@@ -122,64 +94,42 @@ class ExtractionWorker(QObject):
             os.makedirs(modified_path, exist_ok=True)
             os.makedirs(presets_path, exist_ok=True)
 
-            self.finished.emit()
+            self.finished.emit(changed)
         except Exception as e:
             self.error.emit(str(e))
 
 class GenerationWorker(QObject):
     progress = pyqtSignal(int)
     finished = pyqtSignal()
+    error = pyqtSignal(str)
     
-    def __init__(self, skins, accessories, gender, number):
+    def __init__(self, catalog, gender, number, workers=None, seed=None, output_format="png"):
         super().__init__()
-        self.skins = skins
-        self.accessories = accessories
+        self.catalog = catalog
         self.gender = gender
         self.number = number
+        self.seed = seed
+        self.generated = 0
+        self.error_message = None
+        cache_dir = catalog.pixel_cache.cache_dir if catalog.pixel_cache else None
+        self.engine = GenerationEngine(catalog.extract_path, catalog.modified_path, gender,
+                                       os.path.join(BASE_DIR, "datasets"), cache_dir, workers,
+                                       output_format=output_format, memory_budget=catalog.store.max_bytes)
 
     def run(self):
-        datasets_dir = os.path.join(BASE_DIR, "datasets")
-        os.makedirs(datasets_dir, exist_ok=True)
-        layers_order = [
-            "Back Layers",
-            "Skin",
-            "Clothing",
-            "Hair",
-            "Hat",
-            "Mask",
-            "Arm Layers",
-            "Ears",
-            "Hand",
-            "Hostage Layers"
-        ]
-        for i in range(self.number):
-            if not self.skins:
-                continue
-            final_image = random.choice(self.skins).copy()
-            selected_accessories = {}
-            for category, acc_list in self.accessories.items():
-                if acc_list and random.random() < 0.5:
-                    accessory = random.choice(acc_list)
-                    if category not in selected_accessories:
-                        selected_accessories[category] = []
-                    selected_accessories[category].append(accessory)
-            for layer in layers_order:
-                if layer == "Skin":
-                    continue
-                if layer in selected_accessories:
-                    for name, image in selected_accessories[layer]:
-                        if layer == "Back Layers":
-                            bg = Image.new("RGBA", final_image.size)
-                            bg.paste(image, (0, 0), image)
-                            bg.paste(final_image, (0, 0), final_image)
-                            final_image = bg
-                        else:
-                            final_image.paste(image, (0, 0), image)
-            file_path = os.path.join(datasets_dir, f"random_sprite_{i+1}_{self.gender}.png")
-            final_image.save(file_path, "PNG")
-            self.progress.emit(int((i+1) * 100 / self.number))
+        try:
+            tasks = self.engine.plan(self.number, self.seed, catalog=self.catalog)
+            self.generated = self.engine.run(
+                tasks, lambda done, total: self.progress.emit(int(done * 100 / total)))
+        except Exception as e:
+            self.error_message = str(e)
+            self.error.emit(self.error_message)
         self.finished.emit()
 
+    def cancel(self):
+        # Вызывается из потока интерфейса: процессы дорисуют текущее изображение и остановятся
+        self.engine.cancel()
+
 # ------------- Кнопка для пресета -------------
 class PresetButton(QPushButton):
     def __init__(self, preset_name, icon_file, main_window, parent=None):
@@ -289,6 +239,139 @@ class TempBackupNotificationWindow(QDialog):
                     os.rename(icon_file, new_icon_file)
         self.accept()
 
+# ------------- Кэш отрисованных состояний -------------
+class RenderedCharacter:
+    """Готовое состояние персонажа: изображение, его QPixmap и кадры превью.
+
+    Увеличенная копия персонажа и кадры превью строятся один раз на масштаб, так что
+    таймер превью только переключает готовые QPixmap.
+    """
+    __slots__ = ("image", "pixmap", "scaled_pixmap", "scale", "frames", "preview_pixmaps", "preview_scale")
+
+    def __init__(self, image, pixmap, frames):
+        self.image = image
+        self.pixmap = pixmap
+        self.scaled_pixmap = None
+        self.scale = None
+        self.frames = frames
+        self.preview_pixmaps = []
+        self.preview_scale = None
+
+    def scaled(self, scale):
+        if self.scale != scale:
+            self.scaled_pixmap = self.pixmap.scaled(self.pixmap.size() * scale, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            self.scale = scale
+        return self.scaled_pixmap
+
+    def preview(self, scale, to_pixmap):
+        """QPixmap кадров превью, увеличенных в scale раз без сглаживания."""
+        if self.preview_scale != scale:
+            self.preview_pixmaps = [
+                to_pixmap(frame.resize((int(frame.width * scale), int(frame.height * scale)), Image.NEAREST))
+                for frame in self.frames
+            ]
+            self.preview_scale = scale
+        return self.preview_pixmaps
+
+    @property
+    def nbytes(self):
+        # Оценка: RGBA-изображение, его QPixmap, увеличенная копия и кадры превью с их QPixmap
+        width, height = self.image.size
+        scale = self.scale or 1.0
+        preview_scale = self.preview_scale or 1.0
+        frames = sum(frame.width * frame.height * 4 for frame in self.frames)
+        return width * height * 4 * (2 + scale * scale) + frames * (1 + preview_scale * preview_scale)
+
+
+# ------------- Модель списка аксессуаров -------------
+class AccessoryListModel(QAbstractListModel):
+    """Аксессуары текущей категории для QListView.
+
+    Строки – ссылки на записи каталога, виджеты под них не создаются. Иконку строки
+    запрашивает load_icon(entry) в момент, когда вид впервые её рисует; пока иконка
+    грузится в фоне, показывается заглушка, а готовая иконка обновляет только свою
+    строку (icon_ready). Отметки меняются через set_checked: dataChanged уходит только
+    для строк, где отметка изменилась.
+    """
+    toggled = pyqtSignal(str, bool)
+
+    def __init__(self, load_icon, parent=None):
+        super().__init__(parent)
+        self.load_icon = load_icon
+        self.category = None
+        self.items = []
+        self.checked = set()
+        self._source = None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        name, entry = self.items[index.row()]
+        if role == Qt.DisplayRole:
+            return name
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if name in self.checked else Qt.Unchecked
+        if role == Qt.DecorationRole:
+            return self.load_icon(entry)
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsUserCheckable
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or not index.isValid():
+            return False
+        name = self.items[index.row()][0]
+        checked = value == Qt.Checked
+        if checked:
+            self.checked.add(name)
+        else:
+            self.checked.discard(name)
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        self.toggled.emit(name, checked)
+        return True
+
+    def set_category(self, category, items, checked):
+        if category == self.category and items is self._source and len(items) == len(self.items):
+            # Тот же список каталога – обновляются отметки и иконки (цвета могли смениться)
+            self.set_checked(checked)
+            if self.items:
+                self.dataChanged.emit(self.index(0), self.index(len(self.items) - 1), [Qt.DecorationRole])
+            return
+        self.beginResetModel()
+        self.category = category
+        self._source = items
+        self.items = list(items)
+        self.checked = set(checked)
+        self.endResetModel()
+
+    def set_checked(self, names):
+        names = set(names)
+        changed = self.checked ^ names
+        self.checked = names
+        for row, (name, _) in enumerate(self.items):
+            if name in changed:
+                index = self.index(row)
+                self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+
+    def icon_ready(self, entry):
+        for row, (_, item_entry) in enumerate(self.items):
+            if item_entry.source_key == entry.source_key:
+                index = self.index(row)
+                self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def name_at(self, index):
+        return self.items[index.row()][0] if index.isValid() else None
+
+    def clear(self):
+        self.set_category(None, [], [])
+
+
 # ------------------ Основной класс приложения ------------------
 class SpriteCustomizer(QWidget):
     def __init__(self, archive_path):
@@ -300,9 +383,16 @@ class SpriteCustomizer(QWidget):
         self.extract_path = os.path.join(self.base_dir, "extracted_sprites")
         self.modified_path = os.path.join(self.base_dir, "modified_accessories")
         self.presets_path = os.path.join(self.base_dir, "presets")
+        # Декодированные пиксели спрайтов между запусками хранятся в mmap-кэше
+        self.pixel_cache = PixelCache(os.path.join(self.base_dir, "sprite_cache"))
 
         self.gender = "Man"
         self.accessory_file_paths = {}
+        # Каталоги ресурсов для каждого пола держатся в памяти одновременно
+        self.catalogs = {}
+        self.catalog = None
+        # zip и tar читаются прямо из архива, без копии в extracted_sprites
+        self.archive_source = None
 
         # Распаковку запускаем позже, если архив задан
         if self.archive_path and os.path.exists(self.archive_path):
@@ -310,23 +400,44 @@ class SpriteCustomizer(QWidget):
 
         self.current_skin_index = 0
         self.skins = []
+        self.random_seed = random.randrange(1 << 63)
+        self.random_index = 0
+        self.random_seen = {}
         self.current_skin = None
         self.accessories = {}
         self.selected_accessories = {}
-        self.layers_order = [
-            "Back Layers",
-            "Skin",
-            "Clothing",
-            "Hair",
-            "Hat",
-            "Mask",
-            "Arm Layers",
-            "Ears",
-            "Hand",
-            "Hostage Layers"
-        ]
+        self.layers_order = LAYERS_ORDER
         self.colors = {}
         self.accessory_file_paths = {}
+        # Декодированные пиксели и слои всех каталогов – в одном хранилище с бюджетом памяти;
+        # давно не использованные ресурсы вытесняются и перечитываются из дискового кэша
+        settings = QSettings('MyCompany', 'SpriteCustomizer')
+        store_budget = settings.value('assetStoreMegabytes', 256, type=int)
+        self.asset_store = AssetStore(store_budget * 1024 * 1024 if store_budget > 0 else None)
+        # Общий движок наложения и композитор с кэшем частичных стеков для быстрого переключения аксессуаров
+        self.engine = CompositingEngine(lambda entry: self.catalog.load_tiles(entry), self.layers_order,
+                                        self.asset_store)
+        self.compositor = LayerCompositor(self.engine)
+        # Сетка кадров считается по маскам ресурсов, а не по пикселям собранного изображения
+        self.occupancy = OccupancyMasks(lambda entry: self.catalog.load(entry), self.pixel_cache)
+        # Уже отрисованные состояния (отмена, история, пресеты) показываются без пересборки
+        budget = settings.value('renderCacheMegabytes', 256, type=int)
+        self.render_cache = RenderCache(budget * 1024 * 1024)
+        # Миниатюры аксессуаров: атлас на диске и готовые QPixmap в памяти. Каждый цвет
+        # аксессуара – своя иконка, поэтому QPixmap держатся в LRU с бюджетом памяти
+        self.thumbnails = ThumbnailAtlas(os.path.join(self.pixel_cache.cache_dir, "thumbnails"))
+        icon_budget = settings.value('iconCacheMegabytes', 32, type=int)
+        self.thumbnail_pixmaps = LRUCache(icon_budget * 1024 * 1024)
+        self.pending_icons = set()
+        self.icon_placeholder = QPixmap(128, 128)
+        self.icon_placeholder.fill(Qt.transparent)
+        # Индекс атласа сохраняется одним разом после серии подгруженных иконок
+        self.thumbnail_save_timer = QTimer()
+        self.thumbnail_save_timer.setSingleShot(True)
+        self.thumbnail_save_timer.setInterval(1000)
+        self.thumbnail_save_timer.timeout.connect(self.thumbnails.save)
+        # Сохранения из интерфейса пишутся в фоне, чтобы кодирование PNG не подвешивало окно
+        self.writer = WriteService()
 
         # История изменений
         self.history = []
@@ -336,6 +447,7 @@ class SpriteCustomizer(QWidget):
         self.scale_factor = 1.0
         self.preview_scale_factor = 1.0
         self.character_pixmap = None
+        self.rendered = None
 
         self.init_ui()
         QTimer.singleShot(0, self.update_character_display)
@@ -345,20 +457,59 @@ class SpriteCustomizer(QWidget):
             QTimer.singleShot(100, lambda: asyncio.ensure_future(self.open_archive()))
 
     def extract_archive(self):
-        if os.path.exists(self.extract_path):
+        if can_read_directly(self.archive_path):
+            self.open_archive_source()
             return
+        # Окно прогресса появляется, только если распаковка заняла больше полсекунды
+        progress_dialog = QProgressDialog("Распаковка архива...", None, 0, 100, self)
+        progress_dialog.setWindowTitle("Распаковка")
+        progress_dialog.setMinimumDuration(500)
+
+        def on_progress(done, total):
+            progress_dialog.setValue(int(done * 100 / total) if total else 100)
+            progress_dialog.setLabelText(f"Распаковка архива: {done / 1048576:.1f} из {total / 1048576:.1f} МБ")
+
         self.extraction_thread = QThread()
         self.extraction_worker = ExtractionWorker(self.archive_path, self.extract_path)
         self.extraction_worker.moveToThread(self.extraction_thread)
         self.extraction_thread.started.connect(self.extraction_worker.run)
+        self.extraction_worker.progress.connect(on_progress)
+        # reset() скрывает окно и отменяет его отложенный показ
+        self.extraction_worker.finished.connect(progress_dialog.reset)
+        self.extraction_worker.finished.connect(progress_dialog.deleteLater)
         self.extraction_worker.finished.connect(self.on_extraction_finished)
+        self.extraction_worker.error.connect(progress_dialog.reset)
+        self.extraction_worker.error.connect(progress_dialog.deleteLater)
         self.extraction_worker.error.connect(lambda msg: QMessageBox.warning(self, "Ошибка", msg))
+        self.extraction_worker.error.connect(self.extraction_thread.quit)
         self.extraction_worker.finished.connect(self.extraction_thread.quit)
         self.extraction_worker.finished.connect(self.extraction_worker.deleteLater)
         self.extraction_thread.finished.connect(self.extraction_thread.deleteLater)
         self.extraction_thread.start()
 
-    def on_extraction_finished(self):
+    def open_archive_source(self):
+        # Индекс членов кэшируется рядом с архивом, поэтому повторное открытие почти мгновенно
+        try:
+            source = ArchiveSource(self.archive_path)
+        except (OSError, ArchiveError) as e:
+            QMessageBox.warning(self, "Ошибка", str(e))
+            return False
+        self.close_archive_source()
+        self.archive_source = source
+        os.makedirs(self.modified_path, exist_ok=True)
+        os.makedirs(self.presets_path, exist_ok=True)
+        return True
+
+    def close_archive_source(self):
+        # Файл прежнего архива закрывается при смене набора, иначе дескриптор остаётся открытым
+        if self.archive_source is not None:
+            self.archive_source.close()
+            self.archive_source = None
+
+    def on_extraction_finished(self, changed=None):
+        if changed == 0 and self.catalogs:
+            # Распаковка уже была актуальной: каталоги, загруженные при запуске, верны
+            return
         self.load_sprites()
         self.current_skin_index = 0
         self.current_skin = self.skins[self.current_skin_index] if self.skins else None
@@ -366,46 +517,59 @@ class SpriteCustomizer(QWidget):
         if hasattr(self, 'category_list') and self.category_list.currentItem():
             self.display_accessories(self.category_list.currentItem(), None)
         else:
-            self.accessory_list.clear()
+            self.accessory_model.clear()
 
     def load_sprites(self):
-        base_path = os.path.join(self.extract_path, "Construct", self.gender)
-        self.accessories = {layer: [] for layer in self.layers_order if layer != "Skin"}
+        # Полная перезагрузка (например, после распаковки нового архива): сканируется только манифест,
+        # пиксели декодируются при композиции или построении иконки
+        self.catalogs = {}
+        self.render_cache.clear()
+        self.asset_store.clear()
+        for gender in GENDERS:
+            self.get_catalog(gender)
+        self.use_catalog(self.gender)
+
+    def get_catalog(self, gender):
+        catalog = self.catalogs.get(gender)
+        if catalog is None:
+            source_path = self.archive_source.archive_path if self.archive_source else self.extract_path
+            catalog = AssetCatalog(source_path, self.modified_path, gender, self.layers_order,
+                                   pixel_cache=self.pixel_cache, source=self.archive_source,
+                                   store=self.asset_store).scan()
+            self.catalogs[gender] = catalog
+        return catalog
+
+    def use_catalog(self, gender):
+        # Переключение на уже загруженный набор ресурсов без обращения к диску
+        self.catalog = self.get_catalog(gender)
+        self.accessories = self.catalog.accessories
         self.selected_accessories = {key: [] for key in self.accessories.keys()}
-        self.skins = []
-        self.current_skin = None
+        self.skins = self.catalog.skins
+        self.current_skin = self.skins[0] if self.skins else None
         self.colors = {}
-        self.accessory_file_paths = {}
-
-        if os.path.exists(base_path):
-            for root, dirs, files in os.walk(base_path):
-                category = os.path.basename(root)
-                for file in files:
-                    if file.endswith(".png"):
-                        image_path = os.path.join(root, file)
-                        image = Image.open(image_path).convert("RGBA")
-                        if category == "Skin":
-                            self.skins.append(image)
-                            if self.current_skin is None:
-                                self.current_skin = image
-                        elif category in self.accessories:
-                            self.accessories[category].append((file, image))
-                            self.accessory_file_paths[(category, file)] = image_path
-
-        modified_base_path = os.path.join(self.modified_path, self.gender)
-        if os.path.exists(modified_base_path):
-            for root, dirs, files in os.walk(modified_base_path):
-                category = os.path.basename(root)
-                for file in files:
-                    if file.endswith(".png"):
-                        image_path = os.path.join(root, file)
-                        image = Image.open(image_path).convert("RGBA")
-                        if category in self.accessories:
-                            self.accessories[category].append((file, image))
-                            self.accessory_file_paths[(category, file)] = image_path
-                        else:
-                            self.accessories[category] = [(file, image)]
-                            self.accessory_file_paths[(category, file)] = image_path
+        self.accessory_file_paths = self.catalog.file_paths
+        if hasattr(self, 'gender_selector'):
+            self.gender_selector.setToolTip(self.asset_memory_report())
+
+    def asset_memory_report(self):
+        lines = []
+        for gender, catalog in self.catalogs.items():
+            lines.append(f"{gender}: {catalog.asset_count()} ресурсов, "
+                         f"{catalog.resident_bytes() / (1024 * 1024):.1f} МБ декодировано")
+        if hasattr(self, 'engine'):
+            lines.append(f"Слои наложения: {self.engine.cached_bytes() / (1024 * 1024):.1f} МБ")
+        if hasattr(self, 'asset_store'):
+            lines.append("Хранилище ресурсов: " + self.asset_store.report())
+        if hasattr(self, 'render_cache'):
+            lines.append("Кэш отрисовки: " + self.render_cache.report())
+        return "\n".join(lines)
+
+    def set_gender_silently(self, gender):
+        # Смена пола из истории/пресета не должна повторно вызывать change_gender
+        self.gender = gender
+        self.gender_selector.blockSignals(True)
+        self.gender_selector.setCurrentText(gender)
+        self.gender_selector.blockSignals(False)
 
     @asyncSlot()
     async def init_ui(self):
@@ -428,7 +592,7 @@ class SpriteCustomizer(QWidget):
             QPushButton:hover {
                 background-color: #45a049;
             }
-            QListWidget {
+            QListView {
                 background-color: #3E3E3E;
             }
             QComboBox {
@@ -441,8 +605,11 @@ class SpriteCustomizer(QWidget):
             }
         """)
 
-        self.accessory_list = QListWidget()
-        self.accessory_list.itemClicked.connect(self.toggle_accessory)
+        self.accessory_model = AccessoryListModel(self.accessory_icon, self)
+        self.accessory_model.toggled.connect(self.toggle_accessory)
+        self.accessory_list = QListView()
+        self.accessory_list.setModel(self.accessory_model)
+        self.accessory_list.setUniformItemSizes(True)
         self.accessory_list.setIconSize(QSize(128, 128))
         self.accessory_list.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         self.accessory_list.setContextMenuPolicy(Qt.CustomContextMenu)
@@ -465,7 +632,7 @@ class SpriteCustomizer(QWidget):
         left_panel.addWidget(about_button)
 
         self.gender_selector = QComboBox()
-        self.gender_selector.addItems(["Man", "Woman"])
+        self.gender_selector.addItems(GENDERS)
         self.gender_selector.currentTextChanged.connect(self.change_gender)
         left_panel.addWidget(self.gender_selector)
 
@@ -508,6 +675,17 @@ class SpriteCustomizer(QWidget):
         save_button.clicked.connect(self.save_combined_image)
         character_layout.addWidget(save_button)
 
+        atlas_layout = QHBoxLayout()
+        atlas_button = QPushButton("Экспорт в атлас")
+        atlas_button.setToolTip("Обрезанные кадры персонажа в атласе PNG с описанием кадров в JSON")
+        atlas_button.clicked.connect(self.export_atlas)
+        presets_atlas_button = QPushButton("Атлас из пресетов")
+        presets_atlas_button.setToolTip("Все сохранённые пресеты в одном общем атласе")
+        presets_atlas_button.clicked.connect(self.export_presets_atlas)
+        atlas_layout.addWidget(atlas_button)
+        atlas_layout.addWidget(presets_atlas_button)
+        character_layout.addLayout(atlas_layout)
+
         animation_button = QPushButton("Показать анимацию")
         animation_button.clicked.connect(self.show_animation_window)
         character_layout.addWidget(animation_button)
@@ -527,6 +705,7 @@ class SpriteCustomizer(QWidget):
         redo_button.clicked.connect(self.redo_history)
         random_button = QPushButton("↻")
         random_button.clicked.connect(self.generate_random_character)
+        self.random_button = random_button
         nav_layout.addWidget(undo_button)
         nav_layout.addWidget(redo_button)
         nav_layout.addWidget(random_button)
@@ -560,6 +739,10 @@ class SpriteCustomizer(QWidget):
         color_button = QPushButton("Изменить цвет аксессуара")
         color_button.clicked.connect(self.change_accessory_color)
         accessory_layout.addWidget(color_button)
+        bake_button = QPushButton("Сохранить цвет в файл")
+        bake_button.setToolTip("Записать окрашенный аксессуар в modified_accessories для экспорта")
+        bake_button.clicked.connect(self.bake_accessory_color)
+        accessory_layout.addWidget(bake_button)
         accessory_widget = QWidget()
         accessory_widget.setLayout(accessory_layout)
         self.splitter.addWidget(accessory_widget)
@@ -568,12 +751,14 @@ class SpriteCustomizer(QWidget):
         self.preview_timer.timeout.connect(self.update_preview_animation)
         self.preview_frame_index = 0
         self.preview_animation_frames = []
+        self.preview_pixmaps = []
         self.preview_timer.start(100)
 
         self.load_settings()
         self.scale_factor = 1.0
         self.preview_scale_factor = 1.0
         self.character_pixmap = None
+        self.rendered = None
 
         self.check_temp_backups()
 
@@ -606,9 +791,16 @@ class SpriteCustomizer(QWidget):
                 return
 
         self.archive_path = file_name
+        if can_read_directly(file_name):
+            # Новый набор читается на месте: ни удаления старой распаковки, ни новой не нужно
+            if self.open_archive_source():
+                self.on_extraction_finished()
+            return
+        self.close_archive_source()
 
-        # Удаляем старую распаковку, если она существует
-        if os.path.exists(self.extract_path):
+        # Распаковка с манифестом обновляется на месте (лишние файлы удаляются по манифесту),
+        # старую распаковку без манифеста удаляем целиком
+        if os.path.exists(self.extract_path) and read_extract_manifest(self.extract_path) is None:
             try:
                 import shutil
                 shutil.rmtree(self.extract_path)
@@ -623,23 +815,26 @@ class SpriteCustomizer(QWidget):
             "Это программа для кастомизации спрайтов персонажей.\n\n"
             "Поддерживаемые форматы архивов: ZIP, TAR/TGZ, RAR, 7Z.\n\n"
             "При выборе нового архива приложение НЕ закрывается, а перезагружается.\n"
-            "Маршрут (директория для распаковки и сохранения) задаётся через настройки BASE_DIR."
+            "Маршрут (директория для распаковки и сохранения) задаётся через настройки BASE_DIR.\n\n"
+            "Ресурсы в памяти:\n" + self.asset_memory_report()
         )
         QMessageBox.information(self, "О программе", about_text)
 
     def show_accessory_context_menu(self, pos):
-        item = self.accessory_list.itemAt(pos)
-        if item:
+        accessory_name = self.accessory_model.name_at(self.accessory_list.indexAt(pos))
+        if accessory_name:
             menu = QMenu()
             open_action = QAction("Открыть расположение файла", self)
-            open_action.triggered.connect(lambda: self.open_file_location(item))
+            open_action.triggered.connect(lambda: self.open_file_location(accessory_name))
             menu.addAction(open_action)
             menu.exec_(self.accessory_list.mapToGlobal(pos))
 
-    def open_file_location(self, item):
+    def open_file_location(self, accessory_name):
         category = self.category_list.currentItem().text() if self.category_list.currentItem() else ""
-        accessory_name = item.text()
         file_path = self.accessory_file_paths.get((category, accessory_name))
+        if file_path and self.archive_source is not None and file_path in self.archive_source:
+            # Ресурс лежит внутри архива – открываем папку с архивом
+            file_path = self.archive_source.archive_path
         if file_path and os.path.exists(file_path):
             try:
                 if sys.platform.startswith('win'):
@@ -655,44 +850,32 @@ class SpriteCustomizer(QWidget):
 
     def change_gender(self, gender):
         self.gender = gender
-        self.load_sprites()
+        self.use_catalog(gender)
         self.current_skin_index = 0
         self.current_skin = self.skins[self.current_skin_index] if self.skins else None
         self.update_character_display()
         if self.category_list.currentItem():
             self.display_accessories(self.category_list.currentItem(), None)
         else:
-            self.accessory_list.clear()
+            self.accessory_model.clear()
         self.record_history()
 
     def display_accessories(self, current, previous):
         if current is None:
             return
         category = current.text()
-        self.accessory_list.clear()
         if category in self.accessories:
-            for name, image in self.accessories[category]:
-                item = QListWidgetItem(name)
-                icon_pixmap = self.get_icon_from_sprite(image)
-                item.setIcon(QIcon(icon_pixmap))
-                item.setCheckState(Qt.Unchecked)
-                self.accessory_list.addItem(item)
-                if name in [name for name, _ in self.selected_accessories[category]]:
-                    item.setCheckState(Qt.Checked)
+            checked = [name for name, _ in self.selected_accessories[category]]
+            self.accessory_model.set_category(category, self.accessories[category], checked)
         else:
             QMessageBox.warning(self, "Ошибка", f"Категория '{category}' не найдена.")
 
-    def toggle_accessory(self, item):
+    def toggle_accessory(self, name, checked):
         category = self.category_list.currentItem().text() if self.category_list.currentItem() else ""
-        name = item.text()
         if category in self.accessories:
-            accessory_image = None
-            for acc_name, image in self.accessories[category]:
-                if acc_name == name:
-                    accessory_image = image
-                    break
-            if item.checkState() == Qt.Checked:
-                self.selected_accessories[category].append((name, accessory_image))
+            accessory_entry = self.selection_entry(category, name)
+            if checked:
+                self.selected_accessories[category].append((name, accessory_entry))
             else:
                 self.selected_accessories[category] = [
                     (acc_name, img) for acc_name, img in self.selected_accessories[category] if acc_name != name
@@ -702,60 +885,64 @@ class SpriteCustomizer(QWidget):
         else:
             QMessageBox.warning(self, "Ошибка", f"Категория '{category}' не найдена.")
 
+    def current_accessory_name(self):
+        indexes = self.accessory_list.selectionModel().selectedIndexes()
+        return self.accessory_model.name_at(indexes[0]) if indexes else None
+
     def change_accessory_color(self):
-        selected_items = self.accessory_list.selectedItems()
-        if not selected_items:
+        accessory_name = self.current_accessory_name()
+        if not accessory_name:
             QMessageBox.warning(self, "Внимание", "Пожалуйста, выберите аксессуар для изменения цвета.")
             return
 
-        item = selected_items[0]
-        accessory_name = item.text()
         category = self.category_list.currentItem().text() if self.category_list.currentItem() else ""
+        # modified_ копия уже окрашена: перекрашивается исходный аксессуар
+        if self.catalog.find(category, accessory_name) is None or accessory_name.startswith(MODIFIED_PREFIX):
+            QMessageBox.warning(self, "Ошибка", "Оригинальное изображение не найдено.")
+            return
         color = QColorDialog.getColor()
         if not color.isValid():
             return
 
-        original_image = None
-        for name, image in self.accessories[category]:
-            if name == accessory_name and not name.startswith("modified_"):
-                original_image = image
-                break
-        if original_image is None:
-            QMessageBox.warning(self, "Ошибка", "Оригинальное изображение не найдено.")
+        # Цвет – параметр выбора: компоновщик умножает слой на него при отрисовке,
+        # файл аксессуара не копируется
+        self.colors[accessory_name] = color
+        self.selected_accessories[category] = [
+            (name, entry) for name, entry in self.selected_accessories[category] if name != accessory_name
+        ]
+        self.selected_accessories[category].append((accessory_name, self.selection_entry(category, accessory_name)))
+        self.accessory_model.set_checked(name for name, _ in self.selected_accessories[category])
+        self.accessory_model.icon_ready(self.catalog.find(category, accessory_name))
+        self.update_character_display()
+        self.record_history()
+
+    def bake_accessory_color(self):
+        # Сохраняет окрашенный аксессуар отдельным modified_ файлом – для экспорта листа
+        accessory_name = self.current_accessory_name()
+        if not accessory_name:
+            QMessageBox.warning(self, "Внимание", "Пожалуйста, выберите аксессуар.")
+            return
+        category = self.category_list.currentItem().text() if self.category_list.currentItem() else ""
+        entry = self.catalog.find(category, accessory_name)
+        if entry is None or accessory_name not in self.colors:
+            QMessageBox.warning(self, "Внимание", "Сначала измените цвет аксессуара.")
             return
 
-        colored_image = self.tint_image(original_image, color)
+        colored_image = self.tint_image(self.catalog.load(entry), self.colors[accessory_name])
         unique_id = str(uuid.uuid4())[:8]
         new_accessory_name = f"modified_{accessory_name}_{unique_id}.png"
-
-        modified_category_path = os.path.join(self.modified_path, self.gender, category)
-        os.makedirs(modified_category_path, exist_ok=True)
-        save_path = os.path.join(modified_category_path, new_accessory_name)
-        colored_image.save(save_path, "PNG")
-        self.accessory_file_paths[(category, new_accessory_name)] = save_path
-        self.accessories[category].append((new_accessory_name, colored_image))
-        self.selected_accessories[category] = [
-            (name, img) for name, img in self.selected_accessories[category] if name != accessory_name
-        ]
+        save_path = os.path.join(self.modified_path, self.gender, category, new_accessory_name)
+        self.write_files([self.writer.write_image(save_path, colored_image)])
+        self.catalog.add_accessory(category, new_accessory_name, save_path, colored_image)
         self.display_accessories(self.category_list.currentItem(), None)
-        items = self.accessory_list.findItems(new_accessory_name, Qt.MatchExactly)
-        if items:
-            new_item = items[0]
-            new_item.setCheckState(Qt.Checked)
-            self.selected_accessories[category].append((new_accessory_name, colored_image))
-        prev_items = self.accessory_list.findItems(accessory_name, Qt.MatchExactly)
-        if prev_items:
-            prev_item = prev_items[0]
-            prev_item.setCheckState(Qt.Unchecked)
-        self.colors[new_accessory_name] = color
-        self.update_character_display()
-        self.record_history()
+
+    def selection_entry(self, category, name):
+        """Запись каталога для выбора с учётом цвета аксессуара из self.colors."""
+        color = self.colors.get(name)
+        return self.catalog.selection_entry(category, name, color.getRgb()[:3] if color is not None else None)
 
     def tint_image(self, image, tint_color):
-        image = image.convert("RGBA")
-        tint_image = Image.new("RGBA", image.size, tint_color.getRgb())
-        blended = ImageChops.multiply(image, tint_image)
-        return blended
+        return tint_image(image, tint_color.getRgb()[:3])
 
     def prev_skin(self):
         if self.skins:
@@ -775,97 +962,81 @@ class SpriteCustomizer(QWidget):
         if not self.current_skin:
             return
 
-        final_image = self.current_skin.copy()
-        for layer in self.layers_order:
-            if layer == "Skin":
-                continue
-            for name, image in self.selected_accessories.get(layer, []):
-                if layer == "Back Layers":
-                    bg = Image.new("RGBA", final_image.size)
-                    bg.paste(image, (0, 0), image)
-                    bg.paste(final_image, (0, 0), final_image)
-                    final_image = bg
-                else:
-                    final_image.paste(image, (0, 0), image)
-
-        full_pixmap = self.pil2pixmap(final_image)
-        self.character_pixmap = full_pixmap
-        scaled_pixmap = full_pixmap.scaled(full_pixmap.size() * self.scale_factor, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        self.character_label.setPixmap(scaled_pixmap)
-        self.final_image = final_image
-        self.preview_animation_frames = self.auto_slice_sprite_sheet(final_image)
+        key = self.render_key()
+        rendered = self.render_cache.get(key)
+        if rendered is None:
+            final_image = self.compositor.compose(self.current_skin, self.selected_accessories)
+            # Для превью берётся первая строка анимаций, кадры обрезаются по непрозрачным пикселям
+            grid = self.occupancy.grid(self.selected_entries(), final_image.size, trim=True)
+            frames = crop_frames(final_image, grid[:1])[0] if grid else []
+            rendered = RenderedCharacter(final_image, to_pixmap(final_image), frames)
+            rendered.scaled(self.scale_factor)
+            rendered.preview(self.preview_scale_factor * 3, to_pixmap)
+            self.render_cache.put(key, rendered, rendered.nbytes)
+            if hasattr(self, 'gender_selector'):
+                # Сборка могла подгрузить или вытеснить ресурсы – статистика памяти обновляется
+                self.gender_selector.setToolTip(self.asset_memory_report())
+
+        self.rendered = rendered
+        self.character_pixmap = rendered.pixmap
+        self.character_label.setPixmap(rendered.scaled(self.scale_factor))
+        self.final_image = rendered.image
+        self.preview_animation_frames = rendered.frames
+        self.preview_pixmaps = rendered.preview(self.preview_scale_factor * 3, to_pixmap)
         self.preview_frame_index = 0
 
-    def auto_slice_sprite_sheet(self, sprite_sheet):
-        slices = []
-        gray_image = sprite_sheet.convert("L")
-        pixels = gray_image.load()
-        width, height = gray_image.size
-        y_slices = []
-        in_sprite = False
-        for y in range(height):
-            is_transparent_row = all(pixels[x, y] == 0 for x in range(width))
-            if not is_transparent_row and not in_sprite:
-                start_y = y
-                in_sprite = True
-            elif is_transparent_row and in_sprite:
-                end_y = y
-                in_sprite = False
-                y_slices.append((start_y, end_y))
-        if in_sprite:
-            y_slices.append((start_y, height))
-        if y_slices:
-            start_y, end_y = y_slices[0]
-            animation_frames = []
-            x_slices = []
-            in_frame = False
-            for x in range(width):
-                is_transparent_column = all(pixels[x, yy] == 0 for yy in range(start_y, end_y))
-                if not is_transparent_column and not in_frame:
-                    start_x = x
-                    in_frame = True
-                elif is_transparent_column and in_frame:
-                    end_x = x
-                    in_frame = False
-                    x_slices.append((start_x, end_x))
-            if in_frame:
-                x_slices.append((start_x, width))
-            for start_x, end_x in x_slices:
-                frame = sprite_sheet.crop((start_x, start_y, end_x, end_y))
-                centered_frame = self.center_frame(frame)
-                animation_frames.append(centered_frame)
-            slices = animation_frames
-        return slices
-
-    def center_frame(self, frame):
-        bbox = frame.getbbox()
-        if bbox:
-            frame = frame.crop(bbox)
-        else:
-            return frame
-        max_width = frame.width
-        max_height = frame.height
-        canvas = Image.new('RGBA', (max_width, max_height), (0, 0, 0, 0))
-        x_offset = (max_width - frame.width) // 2
-        y_offset = (max_height - frame.height) // 2
-        canvas.paste(frame, (x_offset, y_offset), frame)
-        return canvas
+    def render_key(self):
+        """Ключ полного состояния персонажа для кэша отрисовки.
+
+        Окраска входит в ключ через записи каталога: entry.key окрашенной записи
+        включает цвет.
+        """
+        selection = tuple((layer, tuple(entry.key for _, entry in self.selected_accessories.get(layer, [])))
+                          for layer in self.layers_order if self.selected_accessories.get(layer))
+        return (self.gender, self.current_skin.key, selection)
+
+    def selected_entries(self):
+        entries = [self.current_skin] if self.current_skin else []
+        for layer in self.layers_order:
+            entries.extend(entry for _, entry in self.selected_accessories.get(layer, []))
+        return entries
 
     def update_preview_animation(self):
-        if not self.preview_animation_frames:
+        # Кадры уже переведены в QPixmap нужного масштаба – тик только меняет картинку
+        if not self.preview_pixmaps:
             return
-        frame = self.preview_animation_frames[self.preview_frame_index % len(self.preview_animation_frames)]
-        scale_factor = self.preview_scale_factor * 3
-        frame = frame.resize((int(frame.width * scale_factor), int(frame.height * scale_factor)), Image.NEAREST)
-        pixmap = self.pil2pixmap(frame)
-        self.preview_label.setPixmap(pixmap)
-        self.preview_frame_index = (self.preview_frame_index + 1) % len(self.preview_animation_frames)
-
-    def get_icon_from_sprite(self, image, size=128):
-        sprite_width, sprite_height = 64, 64
-        single_sprite = image.crop((0, 0, sprite_width, sprite_height))
-        single_sprite = single_sprite.resize((size, size), Image.LANCZOS)
-        return self.pil2pixmap(single_sprite)
+        self.preview_label.setPixmap(self.preview_pixmaps[self.preview_frame_index % len(self.preview_pixmaps)])
+        self.preview_frame_index = (self.preview_frame_index + 1) % len(self.preview_pixmaps)
+
+    def accessory_icon(self, entry):
+        # Вызывается моделью только для видимых строк; повторно – поиск в словаре.
+        # Иконка показывает аксессуар в выбранном цвете, поэтому ключ – entry.key с окраской
+        color = self.colors.get(entry.name)
+        if color is not None:
+            entry = entry.tinted(selection_tint(entry.name, color.getRgb()[:3]))
+        pixmap = self.thumbnail_pixmaps.get(entry.key)
+        if pixmap is not None:
+            return pixmap
+        if entry.key not in self.pending_icons:
+            self.pending_icons.add(entry.key)
+            asyncio.ensure_future(self.load_accessory_icon(entry))
+        return self.icon_placeholder
+
+    async def load_accessory_icon(self, entry):
+        # Чтение атласа или построение миниатюры – в пуле потоков, QPixmap – в потоке интерфейса
+        try:
+            image = await asyncio.get_event_loop().run_in_executor(None, self.accessory_thumbnail, entry)
+        finally:
+            self.pending_icons.discard(entry.key)
+        pixmap = to_pixmap(image)
+        self.thumbnail_pixmaps.put(entry.key, pixmap, pixmap.width() * pixmap.height() * 4)
+        self.accessory_model.icon_ready(entry)
+        self.thumbnail_save_timer.start()
+
+    def accessory_thumbnail(self, entry):
+        # Атлас хранит миниатюры исходных файлов; цвет накладывается на готовую миниатюру
+        image = self.thumbnails.get(entry, self.catalog.load)
+        return tint_image(image, entry.tint) if entry.tint is not None else image
 
     @asyncSlot()
     async def save_combined_image(self):
@@ -874,13 +1045,74 @@ class SpriteCustomizer(QWidget):
             exports_dir = os.path.join(self.base_dir, "exports")
             os.makedirs(exports_dir, exist_ok=True)
             file_path = os.path.join(exports_dir, f"{image_name}.png")
-            self.final_image.save(file_path, "PNG")
+            self.write_files([self.writer.write_image(file_path, self.final_image)])
+
+    @asyncSlot()
+    async def export_atlas(self):
+        atlas_name, ok = await async_get_text(self, "Экспорт в атлас", "Введите название атласа:")
+        if ok and atlas_name and self.final_image is not None:
+            await self.write_atlas(atlas_name, [(atlas_name, self.final_image)])
+
+    @asyncSlot()
+    async def export_presets_atlas(self):
+        presets = self.saved_presets()
+        if not presets:
+            QMessageBox.information(self, "Атлас из пресетов", "Нет сохранённых пресетов.")
+            return
+        atlas_name, ok = await async_get_text(self, "Атлас из пресетов",
+                                              f"Пресетов: {len(presets)}. Введите название атласа:")
+        if not (ok and atlas_name):
+            return
+        # Каталоги берутся здесь, в потоке интерфейса; сборка листов – в пуле потоков
+        catalogs = {gender: self.get_catalog(gender) for gender in GENDERS}
+        sheets = await asyncio.get_event_loop().run_in_executor(None, render_presets, presets, catalogs.get)
+        await self.write_atlas(atlas_name, sheets)
+
+    def saved_presets(self):
+        presets = []
+        if os.path.exists(self.presets_path):
+            for file_name in sorted(os.listdir(self.presets_path)):
+                if is_saved_preset(file_name):
+                    try:
+                        presets.append((os.path.splitext(file_name)[0],
+                                        load_preset(os.path.join(self.presets_path, file_name))))
+                    except (OSError, ValueError):
+                        continue
+        return presets
+
+    async def write_atlas(self, atlas_name, sheets):
+        png_path, json_path = atlas_paths(os.path.join(self.base_dir, "exports", atlas_name))
+        try:
+            atlas, data = await asyncio.get_event_loop().run_in_executor(
+                None, build_atlas, sheets, os.path.basename(png_path))
+        except ValueError as e:
+            QMessageBox.warning(self, "Ошибка", str(e))
+            return
+        self.write_files([self.writer.write_image(png_path, atlas), self.writer.write_json(json_path, data)])
+
+    def write_files(self, futures, on_done=None):
+        """Ждёт фоновые записи в цикле событий, затем вызывает on_done в потоке интерфейса."""
+        async def wait():
+            try:
+                await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+            except Exception as e:
+                QMessageBox.warning(self, "Ошибка", f"Не удалось сохранить файл: {e}")
+            if on_done is not None:
+                on_done()
+        asyncio.ensure_future(wait())
 
-    def pil2pixmap(self, image):
-        image = image.convert("RGBA")
-        data = image.tobytes("raw", "RGBA")
-        qim = QImage(data, image.width, image.height, QImage.Format_RGBA8888)
-        return QPixmap.fromImage(qim)
+    def preset_writes(self, preset_name):
+        config = {
+            'gender': self.gender,
+            'current_skin_index': self.current_skin_index,
+            'selected_accessories': {k: [name for name, _ in v] for k, v in self.selected_accessories.items()},
+            'colors': {name: self.colors[name].name() for name in self.colors}
+        }
+        futures = [self.writer.write_json(os.path.join(self.presets_path, f"{preset_name}.json"), config)]
+        if self.preview_animation_frames:
+            icon_file = os.path.join(self.presets_path, f"{preset_name}.png")
+            futures.append(self.writer.write_image(icon_file, self.preview_animation_frames[0]))
+        return futures
 
     def save_settings(self):
         settings = QSettings('MyCompany', 'SpriteCustomizer')
@@ -895,56 +1127,44 @@ class SpriteCustomizer(QWidget):
     def closeEvent(self, event):
         self.save_settings()
         self.auto_save_temp_backup()
+        # Все поставленные в очередь записи должны попасть на диск до выхода
+        self.writer.flush()
+        self.thumbnails.save()
         super().closeEvent(event)
 
     def show_animation_window(self):
-        self.animation_window = AnimationWindow(self.final_image)
+        grid = self.occupancy.grid(self.selected_entries(), self.final_image.size)
+        self.animation_window = AnimationWindow(self.final_image, grid)
         self.animation_window.show()
 
     @asyncSlot()
     async def save_character_config(self):
         preset_name, ok = await async_get_text(self, "Сохранить пресет", "Введите название пресета:")
         if ok and preset_name:
-            config = {
-                'gender': self.gender,
-                'current_skin_index': self.current_skin_index,
-                'selected_accessories': {k: [name for name, _ in v] for k, v in self.selected_accessories.items()},
-                'colors': {name: self.colors[name].name() for name in self.colors}
-            }
-            preset_dir = self.presets_path
-            os.makedirs(preset_dir, exist_ok=True)
-            preset_file = os.path.join(preset_dir, f"{preset_name}.json")
-            with open(preset_file, 'w') as f:
-                json.dump(config, f)
-            icon_file = os.path.join(preset_dir, f"{preset_name}.png")
-            if self.preview_animation_frames:
-                self.preview_animation_frames[0].save(icon_file, "PNG")
-            self.load_presets_list()
+            self.write_files(self.preset_writes(preset_name), self.load_presets_list)
             self.record_history()
 
     def load_character_config(self, preset_file):
         with open(preset_file, 'r') as f:
             config = json.load(f)
-        self.gender = config.get('gender', 'Man')
-        self.gender_selector.setCurrentText(self.gender)
-        self.load_sprites()
+        self.set_gender_silently(config.get('gender', 'Man'))
+        self.use_catalog(self.gender)
         self.current_skin_index = config.get('current_skin_index', 0)
         self.current_skin = self.skins[self.current_skin_index] if self.skins else None
-        self.selected_accessories = {k: [] for k in self.accessories.keys()}
-        for category, names in config.get('selected_accessories', {}).items():
-            for name in names:
-                for acc_name, image in self.accessories.get(category, []):
-                    if acc_name == name:
-                        self.selected_accessories[category].append((acc_name, image))
-                        break
         self.colors = {}
         for name, color_name in config.get('colors', {}).items():
             self.colors[name] = QColor(color_name)
+        self.selected_accessories = {k: [] for k in self.accessories.keys()}
+        for category, names in config.get('selected_accessories', {}).items():
+            for name in names:
+                entry = self.selection_entry(category, name)
+                if entry is not None:
+                    self.selected_accessories[category].append((name, entry))
         self.update_character_display()
         if self.category_list.currentItem():
             self.display_accessories(self.category_list.currentItem(), None)
         else:
-            self.accessory_list.clear()
+            self.accessory_model.clear()
         self.record_history()
 
     def clear_preset(self):
@@ -956,7 +1176,7 @@ class SpriteCustomizer(QWidget):
         if self.category_list.currentItem():
             self.display_accessories(self.category_list.currentItem(), None)
         else:
-            self.accessory_list.clear()
+            self.accessory_model.clear()
         self.record_history()
 
     def load_presets_list(self):
@@ -991,34 +1211,63 @@ class SpriteCustomizer(QWidget):
         spin_box = QSpinBox()
         spin_box.setRange(1, 10000)
         layout.addWidget(spin_box)
+        format_selector = QComboBox()
+        format_selector.addItem("PNG-файлы", "png")
+        format_selector.addItem("TAR-шарды с индексом", "tar")
+        format_selector.addItem("RGBA-массив (mmap) с индексом", "array")
+        layout.addWidget(format_selector)
         progress_bar = QProgressBar()
         layout.addWidget(progress_bar)
         generate_button = QPushButton("Сгенерировать")
         layout.addWidget(generate_button)
+        cancel_button = QPushButton("Отмена")
+        layout.addWidget(cancel_button)
 
         loop = asyncio.get_event_loop()
         future = loop.create_future()
 
-        def on_generate():
+        def on_finished():
+            worker = self.generation_worker
+            # Об ошибке уже сообщил обработчик сигнала error – итог генерации не показывается
+            if worker.error_message is not None:
+                pass
+            elif worker.engine.cancelled:
+                QMessageBox.information(self, "Генерация остановлена", f"Сгенерировано {worker.generated} из {worker.number} спрайтов.\nЗерно: {worker.engine.seed}\n\n{worker.engine.stage_report()}")
+            else:
+                QMessageBox.information(self, "Генерация завершена", f"Сгенерировано {worker.generated} спрайтов.\nЗерно: {worker.engine.seed}\n\n{worker.engine.stage_report()}")
             dialog.close()
-            skins_copy = self.skins[:]
-            accessories_copy = {}
-            for cat, lst in self.accessories.items():
-                accessories_copy[cat] = lst[:]
+            if not future.done():
+                future.set_result(True)
+
+        def on_generate():
+            generate_button.setEnabled(False)
+            spin_box.setEnabled(False)
+            format_selector.setEnabled(False)
             gender = self.gender
             self.generation_thread = QThread()
-            self.generation_worker = GenerationWorker(skins_copy, accessories_copy, gender, spin_box.value())
+            self.generation_worker = GenerationWorker(self.catalog, gender, spin_box.value(),
+                                                      output_format=format_selector.currentData())
             self.generation_worker.moveToThread(self.generation_thread)
             self.generation_thread.started.connect(self.generation_worker.run)
             self.generation_worker.progress.connect(progress_bar.setValue)
-            self.generation_worker.finished.connect(lambda: QMessageBox.information(self, "Генерация завершена", f"Сгенерировано {spin_box.value()} спрайтов."))
-            self.generation_worker.finished.connect(lambda: future.set_result(True))
+            self.generation_worker.error.connect(lambda msg: QMessageBox.warning(self, "Ошибка", msg))
+            self.generation_worker.finished.connect(on_finished)
             self.generation_worker.finished.connect(self.generation_thread.quit)
             self.generation_worker.finished.connect(self.generation_worker.deleteLater)
             self.generation_thread.finished.connect(self.generation_thread.deleteLater)
             self.generation_thread.start()
 
+        def on_cancel():
+            if not generate_button.isEnabled():
+                cancel_button.setEnabled(False)
+                self.generation_worker.cancel()
+            else:
+                dialog.close()
+                if not future.done():
+                    future.set_result(False)
+
         generate_button.clicked.connect(on_generate)
+        cancel_button.clicked.connect(on_cancel)
         dialog.show()
         await future
 
@@ -1033,11 +1282,12 @@ class SpriteCustomizer(QWidget):
         factor = 1.1 if delta > 0 else 0.9
         if label == self.character_label:
             self.scale_factor *= factor
-            if self.character_pixmap:
-                scaled_pixmap = self.character_pixmap.scaled(self.character_pixmap.size() * self.scale_factor, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                label.setPixmap(scaled_pixmap)
+            if self.rendered:
+                label.setPixmap(self.rendered.scaled(self.scale_factor))
         elif label == self.preview_label:
             self.preview_scale_factor *= factor
+            if self.rendered:
+                self.preview_pixmaps = self.rendered.preview(self.preview_scale_factor * 3, to_pixmap)
 
     # ------------- Логика истории (undo/redo) -------------
     def record_history(self):
@@ -1053,27 +1303,25 @@ class SpriteCustomizer(QWidget):
         self.history_index = len(self.history) - 1
 
     def restore_history_state(self, state):
-        self.gender = state.get('gender', 'Man')
-        self.gender_selector.setCurrentText(self.gender)
-        self.load_sprites()
+        self.set_gender_silently(state.get('gender', 'Man'))
+        self.use_catalog(self.gender)
         self.current_skin_index = state.get('current_skin_index', 0)
         self.current_skin = self.skins[self.current_skin_index] if self.skins else None
+        self.colors = {}
+        for name, color_name in state.get('colors', {}).items():
+            self.colors[name] = QColor(color_name)
         new_selected = {k: [] for k in self.accessories.keys()}
         for category, names in state.get('selected_accessories', {}).items():
             for name in names:
-                for acc_name, image in self.accessories.get(category, []):
-                    if acc_name == name:
-                        new_selected[category].append((acc_name, image))
-                        break
+                entry = self.selection_entry(category, name)
+                if entry is not None:
+                    new_selected[category].append((name, entry))
         self.selected_accessories = new_selected
-        self.colors = {}
-        for name, color_name in state.get('colors', {}).items():
-            self.colors[name] = QColor(color_name)
         self.update_character_display()
         if self.category_list.currentItem():
             self.display_accessories(self.category_list.currentItem(), None)
         else:
-            self.accessory_list.clear()
+            self.accessory_model.clear()
 
     def undo_history(self):
         if self.history_index > 0:
@@ -1114,36 +1362,12 @@ class SpriteCustomizer(QWidget):
             self.load_presets_list()
 
     def resave_preset(self, preset_name):
-        config = {
-            'gender': self.gender,
-            'current_skin_index': self.current_skin_index,
-            'selected_accessories': {k: [name for name, _ in v] for k, v in self.selected_accessories.items()},
-            'colors': {name: self.colors[name].name() for name in self.colors}
-        }
-        preset_file = os.path.join(self.presets_path, f"{preset_name}.json")
-        with open(preset_file, 'w') as f:
-            json.dump(config, f)
-        icon_file = os.path.join(self.presets_path, f"{preset_name}.png")
-        if self.preview_animation_frames:
-            self.preview_animation_frames[0].save(icon_file, "PNG")
-        self.load_presets_list()
+        self.write_files(self.preset_writes(preset_name), self.load_presets_list)
         self.record_history()
 
     def auto_save_temp_backup(self):
         timestamp = int(time.time())
-        preset_name = f"tempbackup_{timestamp}"
-        config = {
-            'gender': self.gender,
-            'current_skin_index': self.current_skin_index,
-            'selected_accessories': {k: [name for name, _ in v] for k, v in self.selected_accessories.items()},
-            'colors': {name: self.colors[name].name() for name in self.colors}
-        }
-        preset_file = os.path.join(self.presets_path, f"{preset_name}.json")
-        with open(preset_file, 'w') as f:
-            json.dump(config, f)
-        icon_file = os.path.join(self.presets_path, f"{preset_name}.png")
-        if self.preview_animation_frames:
-            self.preview_animation_frames[0].save(icon_file, "PNG")
+        self.preset_writes(f"tempbackup_{timestamp}")
 
     def check_temp_backups(self):
         temp_files = []
@@ -1161,31 +1385,87 @@ class SpriteCustomizer(QWidget):
             notification.exec_()
 
     def generate_random_character(self):
-        if self.skins:
-            self.current_skin_index = random.randrange(len(self.skins))
-            self.current_skin = self.skins[self.current_skin_index]
+        # Номера выборки идут подряд: в пределах сессии комбинации не повторяются,
+        # а любую из них можно воспроизвести по паре (зерно, номер)
+        sampler = CharacterSampler(self.catalog, self.random_seed)
+        if not sampler.combinations:
+            return
+        seen = self.random_seen.setdefault(self.gender, set())
+        tasks = sampler.tasks(1, self.random_index, seen)
+        if not tasks:
+            # Все комбинации уже показаны – круг начинается заново
+            seen.clear()
+            tasks = sampler.tasks(1, self.random_index, seen)
+        index, skin_name, selection = tasks[0]
+        self.random_index = index + 1
+        self.current_skin_index = next(i for i, skin in enumerate(self.skins) if skin.name == skin_name)
+        self.current_skin = self.skins[self.current_skin_index]
         new_selected = {cat: [] for cat in self.accessories.keys()}
-        for category, items in self.accessories.items():
-            if items and random.random() < 0.5:
-                new_selected[category].append(random.choice(items))
+        for category, names in selection.items():
+            for name in names:
+                new_selected[category].append((name, self.selection_entry(category, name)))
         self.selected_accessories = new_selected
+        self.random_button.setToolTip(f"Случайный персонаж (зерно {self.random_seed}, №{index})")
         self.update_character_display()
         self.record_history()
 
 
 # ---------------------- Окно анимации ---------------------------
+class AnimationView(QWidget):
+    """Показывает кадр-QPixmap, увеличенный при отрисовке без сглаживания."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pixmap = None
+        self.scale_factor = 1.0
+
+    def set_pixmap(self, pixmap):
+        self.pixmap = pixmap
+        self.update()
+
+    def set_scale(self, scale_factor):
+        self.scale_factor = scale_factor
+        self.updateGeometry()
+        self.update()
+
+    def scaled_size(self):
+        if self.pixmap is None:
+            return QSize(0, 0)
+        return QSize(int(self.pixmap.width() * self.scale_factor), int(self.pixmap.height() * self.scale_factor))
+
+    def sizeHint(self):
+        return self.scaled_size()
+
+    def paintEvent(self, event):
+        if self.pixmap is None:
+            return
+        size = self.scaled_size()
+        target = QRect((self.width() - size.width()) // 2, (self.height() - size.height()) // 2,
+                       size.width(), size.height())
+        painter = QPainter(self)
+        # Без SmoothPixmapTransform QPainter масштабирует по ближайшему соседу
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, False)
+        painter.drawPixmap(target, self.pixmap)
+        painter.end()
+
+
 class AnimationWindow(QWidget):
-    def __init__(self, sprite_sheet):
+    def __init__(self, sprite_sheet, grid=None):
         super().__init__()
         self.sprite_sheet = sprite_sheet
+        self.grid = grid
         self.init_ui()
         self.scale_factor = 3.0
+        self.animation_view.set_scale(self.scale_factor)
         self.timer = QTimer()
         self.timer.timeout.connect(self.update_frame)
         self.timer.start(100)
         self.frame_index = 0
         self.current_animation_index = 0
         self.slices = self.auto_slice_sprite_sheet()
+        # Центрирование и перевод в QPixmap – один раз на лист, тик только меняет кадр
+        self.centered, self.frame_size = center_frames(self.slices)
+        self.pixmaps = [[to_pixmap(frame) for frame in frames] for frames in self.centered]
 
     def init_ui(self):
         self.setWindowTitle("Анимация персонажа")
@@ -1213,9 +1493,8 @@ class AnimationWindow(QWidget):
         """)
         layout = QVBoxLayout()
         self.setLayout(layout)
-        self.animation_label = QLabel()
-        self.animation_label.setAlignment(Qt.AlignCenter)
-        layout.addWidget(self.animation_label)
+        self.animation_view = AnimationView()
+        layout.addWidget(self.animation_view, 1)
         self.animation_number_label = QLabel()
         self.animation_number_label.setAlignment(Qt.AlignCenter)
         layout.addWidget(self.animation_number_label)
@@ -1232,72 +1511,18 @@ class AnimationWindow(QWidget):
         layout.addWidget(export_gif_button)
 
     def auto_slice_sprite_sheet(self):
-        slices = []
-        gray_image = self.sprite_sheet.convert("L")
-        pixels = gray_image.load()
-        width, height = gray_image.size
-        y_slices = []
-        in_sprite = False
-        for y in range(height):
-            is_transparent_row = all(pixels[x, y] == 0 for x in range(width))
-            if not is_transparent_row and not in_sprite:
-                start_y = y
-                in_sprite = True
-            elif is_transparent_row and in_sprite:
-                end_y = y
-                in_sprite = False
-                y_slices.append((start_y, end_y))
-        if in_sprite:
-            y_slices.append((start_y, height))
-        for start_y, end_y in y_slices:
-            animation_frames = []
-            x_slices = []
-            in_frame = False
-            for x in range(width):
-                is_transparent_column = all(pixels[x, y] == 0 for y in range(start_y, end_y))
-                if not is_transparent_column and not in_frame:
-                    start_x = x
-                    in_frame = True
-                elif is_transparent_column and in_frame:
-                    end_x = x
-                    in_frame = False
-                    x_slices.append((start_x, end_x))
-            if in_frame:
-                x_slices.append((start_x, width))
-            for start_x, end_x in x_slices:
-                frame = self.sprite_sheet.crop((start_x, start_y, end_x, end_y))
-                animation_frames.append(frame)
-            slices.append(animation_frames)
-        return slices
+        grid = self.grid if self.grid is not None else slice_sprite_sheet(self.sprite_sheet)
+        return crop_frames(self.sprite_sheet, grid)
     
     def update_frame(self):
         if not self.slices:
             return
-        animation_frames = self.slices[self.current_animation_index]
-        if not animation_frames:
+        pixmaps = self.pixmaps[self.current_animation_index]
+        if not pixmaps:
             return
-        frame = animation_frames[self.frame_index % len(animation_frames)]
-        frame = self.center_frame(frame)
-        scale_factor = self.scale_factor
-        frame = frame.resize((int(frame.width * scale_factor), int(frame.height * scale_factor)), Image.NEAREST)
-        pixmap = self.pil2pixmap(frame)
-        self.animation_label.setPixmap(pixmap)
+        self.animation_view.set_pixmap(pixmaps[self.frame_index % len(pixmaps)])
         self.animation_number_label.setText(f"Анимация {self.current_animation_index + 1} из {len(self.slices)}")
-        self.frame_index = (self.frame_index + 1) % len(animation_frames)
-
-    def center_frame(self, frame):
-        bbox = frame.getbbox()
-        if bbox:
-            frame = frame.crop(bbox)
-        else:
-            return frame
-        max_width = max(f.width for animation in self.slices for f in animation)
-        max_height = max(f.height for animation in self.slices for f in animation)
-        canvas = Image.new('RGBA', (max_width, max_height), (0, 0, 0, 0))
-        x_offset = (max_width - frame.width) // 2
-        y_offset = (max_height - frame.height) // 2
-        canvas.paste(frame, (x_offset, y_offset), frame)
-        return canvas
+        self.frame_index = (self.frame_index + 1) % len(pixmaps)
 
     def prev_animation(self):
         self.current_animation_index = (self.current_animation_index - 1) % len(self.slices)
@@ -1308,14 +1533,10 @@ class AnimationWindow(QWidget):
         self.frame_index = 0
 
     def export_animation_to_gif(self):
-        animation_frames = self.slices[self.current_animation_index]
-        if not animation_frames:
+        frames = self.centered[self.current_animation_index]
+        if not frames:
             QMessageBox.warning(self, "Ошибка", "Нет кадров для экспорта.")
             return
-        frames = []
-        for frame in animation_frames:
-            centered_frame = self.center_frame(frame)
-            frames.append(centered_frame)
         options = QFileDialog.Options()
         file_name, _ = QFileDialog.getSaveFileName(self, "Сохранить анимацию", "", "GIF Files (*.gif)", options=options)
         if file_name:
@@ -1336,16 +1557,13 @@ class AnimationWindow(QWidget):
         delta = event.angleDelta().y()
         factor = 1.1 if delta > 0 else 0.9
         self.scale_factor *= factor
-        self.update_frame()
-
-    def pil2pixmap(self, image):
-        image = image.convert("RGBA")
-        data = image.tobytes("raw", "RGBA")
-        qim = QImage(data, image.width, image.height, QImage.Format_RGBA8888)
-        return QPixmap.fromImage(qim)
+        # Масштаб применяется при отрисовке, пиксели кадров не пересчитываются
+        self.animation_view.set_scale(self.scale_factor)
 
 
 if __name__ == "__main__":
+    # Нужен для пула процессов генерации в собранном EXE
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     loop = QEventLoop(app)
     asyncio.set_event_loop(loop)
@@ -0,0 +1,276 @@
+import io
+import os
+import json
+import time
+import tarfile
+
+import numpy as np
+from PIL import Image
+
+from npc_writer import atomic_write, image_bytes
+
+# Форматы вывода пакетной генерации:
+#   png   – отдельный PNG-файл на каждое изображение (как раньше);
+#   tar   – шарды random_sprites_<пол>-NNNNN.tar с PNG внутри и индексом рядом;
+#   array – один файл random_sprites_<пол>.rgba: сырые RGBA-кадры одинакового размера
+#           подряд, который читается через np.memmap без распаковки.
+OUTPUT_FORMATS = ("png", "tar", "array")
+
+
+def output_file_name(index, gender):
+    return f"random_sprite_{index + 1}_{gender}.png"
+
+
+def dataset_prefix(gender):
+    return f"random_sprites_{gender}"
+
+
+def manifest_path(output_dir, gender):
+    return os.path.join(output_dir, dataset_prefix(gender) + ".json")
+
+
+def sample_record(task):
+    index, skin_name, selection = task
+    return {"index": index, "skin": skin_name, "selection": selection}
+
+
+def write_json(path, data):
+    atomic_write(path, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+
+# ------------------------- Приёмники изображений -------------------------
+# Приёмник живёт один чанк: encode(image) -> bytes вызывается из потоков кодирования,
+# write(task, data) – из потока записи, close() возвращает записи индекса чанка.
+class PngFileSink:
+    def __init__(self, output_dir, gender, compress_level=6):
+        self.output_dir = output_dir
+        self.gender = gender
+        self.compress_level = compress_level
+        self.records = []
+
+    def encode(self, image):
+        return image_bytes(image, compress_level=self.compress_level)
+
+    def write(self, task, data):
+        name = output_file_name(task[0], self.gender)
+        with open(os.path.join(self.output_dir, name), "wb") as f:
+            f.write(data)
+        record = sample_record(task)
+        record["file"] = name
+        self.records.append(record)
+
+    def close(self):
+        return self.records
+
+
+class EncodedSink:
+    """PNG чанка для tar-набора: байты уходят в основной процесс вместе с записями.
+
+    По шардам их раскладывает TarShardWriter, поэтому размер шарда не связан с
+    размером чанка, который обрабатывает один процесс.
+    """
+
+    def __init__(self, compress_level=6):
+        self.compress_level = compress_level
+        self.records = []
+
+    def encode(self, image):
+        return image_bytes(image, compress_level=self.compress_level)
+
+    def write(self, task, data):
+        record = sample_record(task)
+        record["data"] = data
+        self.records.append(record)
+
+    def close(self):
+        return self.records
+
+
+class TarShardWriter:
+    """Дописывает образцы в tar-шарды по shard_size штук; смещения PNG шарда пишутся в <шард>.json."""
+
+    def __init__(self, output_dir, gender, shard_size=1024):
+        self.output_dir = output_dir
+        self.gender = gender
+        self.shard_size = shard_size
+        self.count = 0
+        self.busy = 0.0
+        self.archive = None
+        self.name = None
+        self.records = []
+
+    def add(self, record):
+        """Пишет PNG из record["data"] и возвращает запись индекса со смещением в шарде."""
+        started = time.perf_counter()
+        data = record.pop("data")
+        if self.archive is None:
+            self.name = f"{dataset_prefix(self.gender)}-{self.count // self.shard_size:05d}.tar"
+            self.archive = tarfile.open(os.path.join(self.output_dir, self.name), "w", format=tarfile.PAX_FORMAT)
+        info = tarfile.TarInfo(output_file_name(record["index"], self.gender))
+        info.size = len(data)
+        self.archive.addfile(info, io.BytesIO(data))
+        # Данные члена – последний блок записи, дополненный до кратного 512 байт
+        offset = self.archive.offset - (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+        record.update(shard=self.name, member=info.name, offset=offset, size=info.size)
+        self.records.append(record)
+        self.count += 1
+        if len(self.records) == self.shard_size:
+            self._close_shard()
+        self.busy += time.perf_counter() - started
+        return record
+
+    def _close_shard(self):
+        self.archive.close()
+        write_json(os.path.join(self.output_dir, self.name) + ".json",
+                   {"format": "tar", "shard": self.name, "samples": self.records})
+        self.archive = None
+        self.records = []
+
+    def close(self):
+        if self.archive is not None:
+            self._close_shard()
+
+    def abort(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+
+class ArraySink:
+    """Пишет кадры в заранее выделенный файл: строка row лежит по смещению row * frame_bytes.
+
+    Размер кадра общий для всего файла; изображения другого размера прикладываются к
+    левому верхнему углу, как листы в компоновщике. Несколько процессов пишут в свои
+    строки одного файла без блокировок.
+    """
+
+    def __init__(self, path, frame_size, rows):
+        self.path = path
+        self.frame_size = frame_size
+        self.frame_bytes = frame_size[0] * frame_size[1] * 4
+        self.rows = rows
+        self.file = open(path, "r+b")
+        self.records = []
+
+    def encode(self, image):
+        if image.size != self.frame_size:
+            canvas = Image.new("RGBA", self.frame_size)
+            canvas.paste(image, (0, 0))
+            image = canvas
+        return image.tobytes("raw", "RGBA")
+
+    def write(self, task, data):
+        row = self.rows[task[0]]
+        self.file.seek(row * self.frame_bytes)
+        self.file.write(data)
+        record = sample_record(task)
+        record.update(row=row, offset=row * self.frame_bytes)
+        self.records.append(record)
+
+    def close(self):
+        self.file.close()
+        return self.records
+
+
+def create_array_file(output_dir, gender, frame_size, count):
+    """Создаёт (обнуляет) файл под count кадров и возвращает путь к нему."""
+    path = os.path.join(output_dir, dataset_prefix(gender) + ".rgba")
+    with open(path, "wb") as f:
+        f.truncate(count * frame_size[0] * frame_size[1] * 4)
+    return path
+
+
+class ManifestWriter:
+    """Общий индекс набора, который пишется по мере готовности чанков.
+
+    Записи образцов не копятся в памяти, а сразу уходят во временный файл рядом с
+    индексом; close() дописывает поля формата и атомарно заменяет им индекс. Чанки
+    завершаются не по порядку: пришедшие раньше своей очереди ждут в буфере (не больше
+    окна чанков в работе), поэтому записи в индексе упорядочены по номеру образца. Для
+    формата tar записи в том же порядке проходят через shards (TarShardWriter).
+    """
+
+    def __init__(self, output_dir, gender, output_format, seed=None, shards=None):
+        self.gender = gender
+        self.output_format = output_format
+        self.path = manifest_path(output_dir, gender)
+        self.tmp_path = self.path + ".tmp"
+        self.count = 0
+        self.shards = shards
+        self.shard_names = set()
+        self._pending = {}
+        self._next_chunk = 0
+        self.file = open(self.tmp_path, "w", encoding="utf-8")
+        header = json.dumps({"format": output_format, "gender": gender, "seed": seed}, ensure_ascii=False)
+        self.file.write(header[:-1] + ', "samples": [')
+
+    def add(self, chunk_number, records):
+        """Записи чанка chunk_number (чанки нумеруются подряд с нуля); отменённый чанк – пустой список."""
+        self._pending[chunk_number] = records
+        while self._next_chunk in self._pending:
+            self._write(self._pending.pop(self._next_chunk))
+            self._next_chunk += 1
+
+    def _write(self, records):
+        for record in sorted(records, key=lambda record: record["index"]):
+            if self.shards is not None:
+                record = self.shards.add(record)
+            self.file.write((", " if self.count else "") + json.dumps(record, ensure_ascii=False))
+            self.count += 1
+            if "shard" in record:
+                self.shard_names.add(record["shard"])
+
+    def close(self, frame_size=None):
+        # После отмены в нумерации чанков могут остаться пропуски
+        for chunk_number in sorted(self._pending):
+            self._write(self._pending.pop(chunk_number))
+        if self.shards is not None:
+            self.shards.close()
+        fields = {}
+        if self.output_format == "tar":
+            fields["shards"] = sorted(self.shard_names)
+        elif self.output_format == "array":
+            width, height = frame_size
+            fields.update(file=dataset_prefix(self.gender) + ".rgba", dtype="uint8", frame_shape=[height, width, 4])
+        self.file.write("]")
+        for key, value in fields.items():
+            self.file.write(f", {json.dumps(key)}: {json.dumps(value, ensure_ascii=False)}")
+        self.file.write("}")
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        if self.shards is not None:
+            self.shards.abort()
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+# ------------------------- Чтение наборов -------------------------
+def load_manifest(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def open_array_dataset(path):
+    """Открывает набор формата array: (np.memmap формы (N, H, W, 4), список записей).
+
+    Строки без записи в индексе (генерация была отменена) остаются нулевыми.
+    """
+    manifest = load_manifest(path)
+    frame_shape = tuple(manifest["frame_shape"])
+    data_path = os.path.join(os.path.dirname(path), manifest["file"])
+    frame_bytes = int(np.prod(frame_shape))
+    count = os.path.getsize(data_path) // frame_bytes
+    frames = np.memmap(data_path, dtype=manifest["dtype"], mode="r", shape=(count,) + frame_shape)
+    return frames, manifest["samples"]
+
+
+def read_tar_sample(output_dir, record):
+    """Читает PNG образца из tar-шарда по смещению из индекса, без разбора архива."""
+    with open(os.path.join(output_dir, record["shard"]), "rb") as f:
+        f.seek(record["offset"])
+        data = f.read(record["size"])
+    return Image.open(io.BytesIO(data))
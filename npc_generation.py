@@ -0,0 +1,516 @@
+import os
+import json
+import time
+import queue
+import random
+import hashlib
+import threading
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from npc_assets import AssetCatalog, AssetStore, PixelCache, LAYERS_ORDER
+from npc_compositor import CompositingEngine
+from npc_dataset import PngFileSink, EncodedSink, ArraySink, TarShardWriter, ManifestWriter, create_array_file
+
+
+# ------------------------- Планирование выборок -------------------------
+MASK64 = (1 << 64) - 1
+
+
+def _mix64(value):
+    # splitmix64: быстрая хэш-функция для раундов перестановки
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+class IndexPermutation:
+    """Детерминированная перестановка чисел 0..size-1, заданная зерном.
+
+    Сеть Фейстеля на ближайшем сверху домене 2^(2k) с "прогулкой по циклу": значения за
+    пределами size снова пропускаются через сеть, пока не попадут в диапазон. Каждый
+    индекс вычисляется независимо, без хранения всей перестановки.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.half_mask = (1 << self.half_bits) - 1
+        self.keys = [_mix64((seed & MASK64) ^ _mix64(r + 1)) for r in range(self.ROUNDS)]
+
+    def _feistel(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix64(key ^ right) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        value = self._feistel(index)
+        while value >= self.size:
+            value = self._feistel(value)
+        return value
+
+
+def selection_hash(skin_name, selection):
+    """Хэш комбинации (скин + аксессуары), не зависящий от порядка категорий."""
+    canonical = json.dumps([skin_name, sorted((k, sorted(v)) for k, v in selection.items() if v)],
+                           ensure_ascii=False)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class CharacterSampler:
+    """Отображает (seed, index) в комбинацию скина и аксессуаров.
+
+    Выборка index тянется генератором, заданным парой (seed, index): случайный скин и в
+    каждой категории с вероятностью 1/2 один случайный аксессуар. Любую выборку можно
+    воспроизвести по её номеру без повторного прогона пакета; повторы комбинаций
+    отсекаются по selection_hash. Имена сортируются, поэтому выборка не зависит от
+    порядка файлов на диске.
+
+    Пространство не больше ENUMERATE_LIMIT комбинаций случайные выборки без повторов
+    быстро исчерпывают, поэтому оно перечисляется целиком: номера 0..combinations-1
+    переставляются IndexPermutation и раскладываются в смешанной системе счисления.
+    """
+
+    ENUMERATE_LIMIT = 1 << 16
+    # Столько повторов подряд означает, что новые комбинации почти не выпадают
+    MAX_REPEATS = 10000
+
+    def __init__(self, catalog, seed=None):
+        self.seed = seed if seed is not None else random.randrange(1 << 63)
+        self.skins = sorted({entry.name for entry in catalog.skins})
+        self.categories = sorted((category, sorted({name for name, _ in items}))
+                                 for category, items in catalog.accessories.items() if items)
+        self.combinations = len(self.skins)
+        for _, names in self.categories:
+            self.combinations *= len(names) + 1
+        self.enumerated = 0 < self.combinations <= self.ENUMERATE_LIMIT
+        self.permutation = IndexPermutation(self.combinations, self.seed) if self.enumerated else None
+
+    def selection(self, index):
+        """Комбинация с номером index: (имя скина, {категория: [имя]})."""
+        if not self.combinations:
+            raise ValueError("Скины не найдены: выбирать не из чего.")
+        if self.enumerated:
+            return self._combination(self.permutation[index % self.combinations])
+        rnd = random.Random((self.seed << 64) | index)
+        selection = {}
+        skin_name = rnd.choice(self.skins)
+        for category, names in self.categories:
+            if rnd.random() < 0.5:
+                selection[category] = [rnd.choice(names)]
+        return skin_name, selection
+
+    def _combination(self, value):
+        value, skin_index = divmod(value, len(self.skins))
+        selection = {}
+        for category, names in self.categories:
+            value, choice = divmod(value, len(names) + 1)
+            if choice:
+                selection[category] = [names[choice - 1]]
+        return self.skins[skin_index], selection
+
+    def count(self, count, start=0):
+        """Сколько задач даст iter_tasks(count, start); без перечисления – верхняя граница."""
+        if self.enumerated:
+            return max(0, min(count, self.combinations - start))
+        return max(0, count) if self.combinations else 0
+
+    def iter_tasks(self, count, start=0, seen=None):
+        """Генератор задач (index, skin, selection) для номеров start..; повторы пропускаются.
+
+        seen – множество selection_hash уже выданных комбинаций (по умолчанию новое);
+        передача своего множества исключает повторы и между вызовами. Если новые
+        комбинации перестают выпадать, задач будет меньше count. Задачи вычисляются по
+        одной, поэтому план на сотни тысяч изображений не держится в памяти.
+        """
+        if not self.combinations:
+            return
+        seen = set() if seen is None else seen
+        produced = 0
+        repeats = 0
+        index = start
+        while produced < count and repeats < self.MAX_REPEATS:
+            if self.enumerated and index >= self.combinations:
+                return
+            skin_name, selection = self.selection(index)
+            index += 1
+            key = selection_hash(skin_name, selection)
+            if key in seen:
+                repeats += 1
+                continue
+            seen.add(key)
+            repeats = 0
+            produced += 1
+            yield index - 1, skin_name, selection
+
+    def tasks(self, count, start=0, seen=None):
+        return list(self.iter_tasks(count, start, seen))
+
+
+# ------------------------- Конвейер сборка -> PNG -> запись -------------------------
+STAGES = ("compose", "encode", "write")
+
+
+def empty_stats():
+    """Счётчики стадий: {стадия: [число элементов, суммарное время работы, с]}."""
+    return {stage: [0, 0.0] for stage in STAGES}
+
+
+def merge_stats(total, stats):
+    for stage, (items, busy) in stats.items():
+        total[stage][0] += items
+        total[stage][1] += busy
+    return total
+
+
+def run_pipeline(tasks, compose, encode, write, encoders=2, queue_size=8, cancelled=None):
+    """Прогоняет задачи через три стадии, соединённые ограниченными очередями.
+
+    compose(task) -> изображение выполняется в вызывающем потоке, encode(image) -> bytes –
+    в encoders потоках, write(task, data) – в одном потоке записи. Кодирование zlib и
+    numpy-наложение отпускают GIL, поэтому стадии действительно перекрываются, а размер
+    очередей ограничивает число изображений в памяти. Возвращает (записано, статистика).
+    """
+    stats = empty_stats()
+    stats_lock = threading.Lock()
+    encode_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    written = [0]
+
+    def account(stage, started):
+        with stats_lock:
+            stats[stage][0] += 1
+            stats[stage][1] += time.perf_counter() - started
+
+    def encoder():
+        while True:
+            item = encode_queue.get()
+            if item is None:
+                return
+            task, image = item
+            if errors:
+                continue  # после ошибки только разгружаем очередь, чтобы сборщик не завис
+            started = time.perf_counter()
+            try:
+                data = encode(image)
+            except Exception as e:
+                errors.append(e)
+                continue
+            account("encode", started)
+            write_queue.put((task, data))
+
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            if errors:
+                continue
+            task, data = item
+            started = time.perf_counter()
+            try:
+                write(task, data)
+            except Exception as e:
+                errors.append(e)
+                continue
+            account("write", started)
+            written[0] += 1
+
+    encoder_threads = [threading.Thread(target=encoder, daemon=True) for _ in range(max(1, encoders))]
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    for thread in encoder_threads:
+        thread.start()
+    writer_thread.start()
+    try:
+        for task in tasks:
+            if errors or (cancelled is not None and cancelled()):
+                break
+            started = time.perf_counter()
+            image = compose(task)
+            account("compose", started)
+            if image is not None:
+                encode_queue.put((task, image))
+    finally:
+        for _ in encoder_threads:
+            encode_queue.put(None)
+        for thread in encoder_threads:
+            thread.join()
+        write_queue.put(None)
+        writer_thread.join()
+    if errors:
+        raise errors[0]
+    return written[0], stats
+
+
+# ------------------------- Процессы-исполнители -------------------------
+# Состояние процесса пула: каталог и движок строятся один раз в инициализаторе,
+# пиксели листов берутся из общего mmap-кэша, поэтому задачи несут только имена ресурсов.
+_worker_state = None
+
+
+def _init_worker(extract_path, modified_path, gender, cache_dir, cancel_event, memory_budget=None):
+    global _worker_state
+    pixel_cache = PixelCache(cache_dir) if cache_dir else None
+    # Тайлы каталога и слои движка делят один бюджет памяти процесса
+    store = AssetStore(memory_budget)
+    catalog = AssetCatalog(extract_path, modified_path, gender, pixel_cache=pixel_cache, store=store).scan()
+    _worker_state = (catalog, CompositingEngine(catalog.load_tiles, store=store), cancel_event)
+
+
+def render_task(catalog, engine, task):
+    index, skin_name, selection = task
+    skin = next((entry for entry in catalog.skins if entry.name == skin_name), None)
+    selected_accessories = {}
+    for category, names in selection.items():
+        for name in names:
+            entry = catalog.find(category, name)
+            if entry is not None:
+                selected_accessories.setdefault(category, []).append((name, entry))
+    return engine.compose(skin, selected_accessories)
+
+
+def make_sink(output, tasks, first_row):
+    """Приёмник чанка по описанию вывода output (словарь, передаётся в процессы через pickle)."""
+    if output["format"] == "tar":
+        return EncodedSink(output["compress_level"])
+    if output["format"] == "array":
+        rows = {task[0]: first_row + i for i, task in enumerate(tasks)}
+        return ArraySink(output["array_path"], output["frame_size"], rows)
+    return PngFileSink(output["dir"], output["gender"], output["compress_level"])
+
+
+def _render_chunk(tasks, output, first_row, encoders):
+    catalog, engine, cancel_event = _worker_state
+    sink = make_sink(output, tasks, first_row)
+    try:
+        written, stats = run_pipeline(tasks, lambda task: render_task(catalog, engine, task),
+                                      sink.encode, sink.write,
+                                      encoders=encoders, cancelled=cancel_event.is_set)
+    finally:
+        records = sink.close()
+    return written, stats, records
+
+
+# ------------------------- Движок пакетной генерации -------------------------
+class GenerationEngine:
+    """Пакетная генерация спрайтов на пуле процессов.
+
+    Задачи берутся из плана лениво и режутся на чанки по chunk_size; в работе не больше
+    двух чанков на процесс, а записи готовых чанков сразу уходят в индекс, так что память
+    не растёт с размером набора. Каждый процесс один раз сканирует каталог и
+    читает пиксели из общего PixelCache, так что листы не передаются через pickle.
+    Внутри процесса чанк проходит конвейер run_pipeline: процесс собирает изображения,
+    encoders потоков кодируют PNG, отдельный поток пишет файлы. После run() в self.stats
+    лежит статистика стадий, stage_report() показывает их пропускную способность.
+    output_format выбирает вид результата (см. npc_dataset.OUTPUT_FORMATS): для "tar"
+    процессы возвращают готовые PNG, а основной процесс по порядку номеров раскладывает
+    их в шарды по shard_size, не завися от размера чанка. Рядом с результатом
+    пишется индекс random_sprites_<пол>.json с выборкой аксессуаров каждого образца.
+    memory_budget – бюджет байт AssetStore в каждом процессе (None – без ограничения).
+    cancel() останавливает работу: процессы завершают текущее изображение и выходят,
+    ещё не начатые чанки отменяются.
+    """
+
+    def __init__(self, extract_path, modified_path, gender, output_dir, cache_dir=None,
+                 workers=None, chunk_size=16, encoders=2, compress_level=6, output_format="png",
+                 shard_size=1024, memory_budget=None):
+        self.extract_path = extract_path
+        self.modified_path = modified_path
+        self.gender = gender
+        self.output_dir = output_dir
+        self.cache_dir = cache_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.encoders = encoders
+        self.compress_level = compress_level
+        self.output_format = output_format
+        self.shard_size = shard_size
+        self.memory_budget = memory_budget
+        self.seed = None
+        self.planned = 0
+        self.frame_size = None
+        self.manifest = None
+        self.stats = empty_stats()
+        self.elapsed = 0.0
+        self._processes = 1
+        # spawn, а не fork: интерфейс запускает генерацию из QThread, пока работают поток Qt,
+        # пул qasync и потоки записи, а fork многопоточного процесса может оставить в
+        # дочернем захваченные блокировки. Состояние процесса всё равно строит _init_worker.
+        self._context = multiprocessing.get_context("spawn")
+        self._cancel_event = self._context.Event()
+
+    def catalog(self):
+        pixel_cache = PixelCache(self.cache_dir) if self.cache_dir else None
+        return AssetCatalog(self.extract_path, self.modified_path, self.gender, LAYERS_ORDER,
+                            pixel_cache=pixel_cache).scan()
+
+    def plan(self, number, seed=None, start=0, seen=None, catalog=None):
+        """Генератор задач для number изображений начиная с номера start.
+
+        Зерно сохраняется в self.seed, число задач – в self.planned (верхняя граница:
+        повторы комбинаций, в том числе из seen, пропускаются по ходу генерации).
+        """
+        catalog = catalog or self.catalog()
+        self.sampler = CharacterSampler(catalog, seed)
+        self.seed = self.sampler.seed
+        self.frame_size = self.canvas_size(catalog)
+        self.planned = self.sampler.count(number, start)
+        return self.sampler.iter_tasks(number, start, seen)
+
+    @staticmethod
+    def canvas_size(catalog):
+        # Холст задаёт скин; для формата array кадр должен вмещать любой из них
+        sizes = [entry.size for entry in catalog.skins]
+        if not sizes:
+            return None
+        return max(width for width, _ in sizes), max(height for _, height in sizes)
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def run(self, tasks, progress=None, total=None):
+        """Выполняет задачи (список или генератор из plan()).
+
+        progress(done, total) вызывается по мере готовности чанков; total по умолчанию –
+        длина списка или self.planned для генератора.
+        """
+        if total is None:
+            total = len(tasks) if isinstance(tasks, (list, tuple)) else self.planned
+        self.stats = empty_stats()
+        self.elapsed = 0.0
+        started = time.perf_counter()
+        try:
+            return self._run(iter(tasks), total, progress)
+        finally:
+            self.elapsed = time.perf_counter() - started
+
+    def _run(self, tasks, total, progress):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if not total:
+            return 0
+        init_args = (self.extract_path, self.modified_path, self.gender, self.cache_dir, self._cancel_event,
+                     self.memory_budget)
+        output = {"format": self.output_format, "dir": self.output_dir, "gender": self.gender,
+                  "compress_level": self.compress_level}
+        if self.output_format == "array":
+            if self.frame_size is None:
+                self.frame_size = self.canvas_size(self.catalog())
+            output["frame_size"] = self.frame_size
+            output["array_path"] = create_array_file(self.output_dir, self.gender, self.frame_size, total)
+        # Чанки – единица работы процессов; в шарды tar образцы собирает основной процесс
+        shards = TarShardWriter(self.output_dir, self.gender, self.shard_size) if self.output_format == "tar" else None
+        manifest = ManifestWriter(self.output_dir, self.gender, self.output_format, self.seed, shards)
+        try:
+            done, rows = self._render(self.chunks(tasks, self.chunk_size), manifest, output, progress, total,
+                                      init_args, -(-total // self.chunk_size))
+        except BaseException:
+            manifest.abort()
+            raise
+        if self.output_format == "array" and rows < total:
+            # Задач вышло меньше плана (повторы из seen, отмена): лишние строки отрезаются
+            width, height = self.frame_size
+            os.truncate(output["array_path"], rows * width * height * 4)
+        self.manifest = manifest.close(self.frame_size)
+        if shards is not None:
+            # В процессах "запись" – только передача байтов; шарды пишет основной процесс
+            self.stats["write"] = [shards.count, shards.busy]
+        return done
+
+    @staticmethod
+    def chunks(tasks, chunk_size):
+        """Лениво режет задачи на чанки: (номер чанка, первая строка, задачи)."""
+        first_row = 0
+        for number in itertools.count():
+            chunk = list(itertools.islice(tasks, chunk_size))
+            if not chunk:
+                return
+            yield number, first_row, chunk
+            first_row += len(chunk)
+
+    def _render(self, chunks, manifest, output, progress, total, init_args, chunk_count):
+        done = 0
+        rows = 0
+        if self.workers == 1:
+            self._processes = 1
+            _init_worker(*init_args)
+            for number, first_row, chunk in chunks:
+                rows = first_row + len(chunk)
+                written, stats, chunk_records = _render_chunk(chunk, output, first_row, self.encoders)
+                done += written
+                merge_stats(self.stats, stats)
+                manifest.add(number, chunk_records)
+                if progress:
+                    progress(done, total)
+                if self.cancelled:
+                    break
+            return done, rows
+
+        self._processes = max(1, min(self.workers, chunk_count))
+        # Окно чанков в работе: процессы не простаивают, а план не выгружается в очередь пула целиком
+        window = 2 * self._processes
+        with ProcessPoolExecutor(max_workers=self._processes, mp_context=self._context,
+                                 initializer=_init_worker, initargs=init_args) as pool:
+            running = {}
+            try:
+                while True:
+                    while len(running) < window and not self.cancelled:
+                        item = next(chunks, None)
+                        if item is None:
+                            break
+                        number, first_row, chunk = item
+                        rows = first_row + len(chunk)
+                        future = pool.submit(_render_chunk, chunk, output, first_row, self.encoders)
+                        running[future] = number
+                    if not running:
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        number = running.pop(future)
+                        if future.cancelled():
+                            manifest.add(number, [])
+                            continue
+                        written, stats, chunk_records = future.result()
+                        done += written
+                        merge_stats(self.stats, stats)
+                        manifest.add(number, chunk_records)
+                        if progress:
+                            progress(done, total)
+                    if self.cancelled:
+                        for pending in running:
+                            pending.cancel()
+            except BaseException:
+                # Ошибка или Ctrl+C: не ждём оставшиеся чанки при закрытии пула
+                self.cancel()
+                for pending in running:
+                    pending.cancel()
+                raise
+        return done, rows
+
+    def stage_report(self):
+        """Пропускная способность стадий последнего запуска; узкое место помечено "<-"."""
+        threads = {"compose": self._processes, "encode": self._processes * max(1, self.encoders),
+                   "write": 1 if self.output_format == "tar" else self._processes}
+        rates = {}
+        for stage in STAGES:
+            items, busy = self.stats[stage]
+            rates[stage] = items / busy * threads[stage] if busy else 0.0
+        bottleneck = min((stage for stage in STAGES if rates[stage]), key=rates.get, default=None)
+        lines = []
+        for stage in STAGES:
+            items, busy = self.stats[stage]
+            load = busy / (self.elapsed * threads[stage]) if self.elapsed else 0.0
+            mark = "  <-" if stage == bottleneck else ""
+            lines.append(f"{stage}: {items} шт., до {rates[stage]:.1f} шт./с "
+                         f"(потоков: {threads[stage]}, загрузка {load:.0%}){mark}")
+        return "\n".join(lines)
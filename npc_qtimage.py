@@ -0,0 +1,65 @@
+"""Перевод PIL-изображений и массивов NumPy в QImage/QPixmap без лишних копий пикселей."""
+import numpy as np
+from PyQt5.QtGui import QImage, QPixmap
+
+from npc_assets import image_buffer
+
+# Режимы PIL, пиксели которых Qt читает как есть
+QIMAGE_FORMATS = {
+    "RGBA": (QImage.Format_RGBA8888, 4),
+    "RGB": (QImage.Format_RGB888, 3),
+    "L": (QImage.Format_Grayscale8, 1),
+}
+ARRAY_FORMATS = {4: "RGBA", 3: "RGB", 1: "L"}
+
+
+def wrap_buffer(buffer, width, height, mode):
+    """QImage поверх буфера без копирования.
+
+    QImage не владеет памятью, поэтому буфер хранится в самом объекте QImage и живёт,
+    пока жив он. Копии QImage, сделанные на стороне Qt, этого не гарантируют: для
+    долгого хранения нужен QPixmap или qimage.copy().
+    """
+    qformat, bands = QIMAGE_FORMATS[mode]
+    qimage = QImage(buffer, width, height, width * bands, qformat)
+    qimage.pixel_buffer = buffer
+    return qimage
+
+
+def array_to_qimage(pixels):
+    """QImage поверх массива uint8 формы (H, W, 4), (H, W, 3) или (H, W)."""
+    if pixels.dtype != np.uint8:
+        raise TypeError(f"Ожидается массив uint8, получен {pixels.dtype}.")
+    bands = 1 if pixels.ndim == 2 else pixels.shape[2]
+    if bands not in ARRAY_FORMATS:
+        raise ValueError(f"Неподдерживаемая форма массива {pixels.shape}.")
+    # Qt требует плотных строк; у непрерывного массива копии не будет
+    pixels = np.ascontiguousarray(pixels)
+    return wrap_buffer(pixels, pixels.shape[1], pixels.shape[0], ARRAY_FORMATS[bands])
+
+
+def pil_to_qimage(image):
+    """QImage с пикселями PIL-изображения.
+
+    Изображения поверх общего буфера (композиции, кэш пикселей, атлас миниатюр)
+    оборачиваются без копирования; для остальных – одна копия tobytes, а convert
+    только для режимов, которых Qt не понимает.
+    """
+    buffer = image_buffer(image)
+    if buffer is not None:
+        return wrap_buffer(buffer, image.width, image.height, "RGBA")
+    if image.mode not in QIMAGE_FORMATS:
+        image = image.convert("RGBA")
+    return wrap_buffer(image.tobytes(), image.width, image.height, image.mode)
+
+
+def to_qimage(source):
+    if isinstance(source, np.ndarray):
+        return array_to_qimage(source)
+    return pil_to_qimage(source)
+
+
+def to_pixmap(source):
+    """QPixmap из PIL-изображения или массива; QPixmap хранит собственную копию пикселей."""
+    return QPixmap.fromImage(to_qimage(source))
+
@@ -0,0 +1,135 @@
+import numpy as np
+from PIL import Image
+
+from npc_assets import LRUCache
+
+
+# ------------------------- Нарезка листа на кадры -------------------------
+def occupied_runs(occupied):
+    """Непрерывные отрезки True в одномерной маске: список (start, end), end не включается."""
+    padded = np.concatenate(([0], np.asarray(occupied, dtype=np.int8), [0]))
+    edges = np.diff(padded)
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
+
+
+def alpha_mask(image):
+    """Маска непрозрачных пикселей листа (height, width)."""
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    return np.asarray(image.getchannel("A")) != 0
+
+
+def slice_mask(mask, trim=False):
+    """Сетка кадров по маске заполненности.
+
+    Строки анимаций – отрезки строк, где есть хотя бы один непрозрачный пиксель;
+    кадры внутри строки – отрезки столбцов этой полосы. Возвращает список строк,
+    каждая – список прямоугольников (x0, y0, x1, y1). При trim=True прямоугольник
+    каждого кадра сжимается до его непрозрачных пикселей.
+    """
+    grid = []
+    for start_y, end_y in occupied_runs(mask.any(axis=1)):
+        band = mask[start_y:end_y]
+        boxes = []
+        for start_x, end_x in occupied_runs(band.any(axis=0)):
+            if trim:
+                rows = np.flatnonzero(band[:, start_x:end_x].any(axis=1))
+                boxes.append((start_x, start_y + int(rows[0]), end_x, start_y + int(rows[-1]) + 1))
+            else:
+                boxes.append((start_x, start_y, end_x, end_y))
+        grid.append(boxes)
+    return grid
+
+
+def slice_sprite_sheet(image, trim=False):
+    return slice_mask(alpha_mask(image), trim)
+
+
+def crop_frames(image, grid):
+    return [[image.crop(box) for box in boxes] for boxes in grid]
+
+
+def center_frames(animations):
+    """Обрезает кадры по содержимому и центрирует на холсте общего для всех анимаций размера.
+
+    Пустые кадры возвращаются без изменений. Результат: (кадры по анимациям, (ширина, высота)).
+    """
+    if not any(animations):
+        return [list(frames) for frames in animations], (0, 0)
+    size = (max(f.width for frames in animations for f in frames),
+            max(f.height for frames in animations for f in frames))
+    centered = []
+    for frames in animations:
+        row = []
+        for frame in frames:
+            bbox = frame.getbbox()
+            if bbox:
+                frame = frame.crop(bbox)
+                canvas = Image.new("RGBA", size, (0, 0, 0, 0))
+                canvas.paste(frame, ((size[0] - frame.width) // 2, (size[1] - frame.height) // 2), frame)
+                frame = canvas
+            row.append(frame)
+        centered.append(row)
+    return centered, size
+
+
+# ------------------------- Маски заполненности ресурсов -------------------------
+class OccupancyMasks:
+    """Маски непрозрачных пикселей каждого ресурса и сетки кадров для комбинаций.
+
+    Непрозрачный пиксель композиции – это пиксель, покрытый хотя бы одним слоем, поэтому
+    сетка кадров персонажа считается по побитовому ИЛИ масок выбранных ресурсов без
+    чтения собранного изображения. Маски хранятся упакованными (np.packbits): в памяти
+    последние max_masks, при заданном pixel_cache – ещё и на диске, под общим с ним
+    ограничением объёма. Сетки запоминаются для последних max_grids наборов ресурсов.
+    """
+
+    def __init__(self, load, pixel_cache=None, max_grids=256, max_masks=512):
+        self.load = load
+        self.pixel_cache = pixel_cache
+        self._masks = LRUCache(max_items=max_masks)
+        self._grids = LRUCache(max_items=max_grids)
+
+    def packed_mask(self, entry, size):
+        # Окраска не меняет альфу, поэтому маска общая для всех цветов одного файла
+        key = ("occupancy", entry.source_key, size)
+        packed = self._masks.get(key)
+        if packed is not None:
+            return packed
+        width, height = size
+        packed_length = (width * height + 7) // 8
+        if self.pixel_cache is not None:
+            data = self.pixel_cache.get_bytes(key)
+            if data is not None and len(data) == packed_length:
+                packed = np.frombuffer(data, dtype=np.uint8)
+        if packed is None:
+            image_mask = alpha_mask(self.load(entry))
+            mask = np.zeros((height, width), dtype=bool)
+            h = min(height, image_mask.shape[0])
+            w = min(width, image_mask.shape[1])
+            mask[:h, :w] = image_mask[:h, :w]
+            packed = np.packbits(mask)
+            if self.pixel_cache is not None:
+                self.pixel_cache.put_bytes(key, packed.tobytes())
+        self._masks.put(key, packed)
+        return packed
+
+    def combined_mask(self, entries, size):
+        width, height = size
+        combined = None
+        for entry in entries:
+            packed = self.packed_mask(entry, size)
+            combined = packed.copy() if combined is None else np.bitwise_or(combined, packed, out=combined)
+        if combined is None:
+            return np.zeros((height, width), dtype=bool)
+        return np.unpackbits(combined, count=width * height).astype(bool).reshape(height, width)
+
+    def grid(self, entries, size, trim=False):
+        """Сетка кадров (как slice_mask) для композиции из entries."""
+        key = (tuple(sorted(entry.source_key for entry in entries)), size, trim)
+        grid = self._grids.get(key)
+        if grid is None:
+            grid = slice_mask(self.combined_mask(entries, size), trim)
+            # Сетки малы: ограничено только их число
+            self._grids.put(key, grid, 0)
+        return grid
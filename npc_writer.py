@@ -0,0 +1,110 @@
+import io
+import os
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def atomic_write(path, data):
+    """Пишет байты во временный файл рядом с path и атомарно заменяет им path.
+
+    data – bytes или список частей (заголовок и пиксели пишутся без склейки в один буфер).
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            for part in (data if isinstance(data, list) else [data]):
+                f.write(part)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def image_bytes(image, format="PNG", **params):
+    buffer = io.BytesIO()
+    image.save(buffer, format, **params)
+    return buffer.getvalue()
+
+
+# ------------------------- Фоновая запись файлов -------------------------
+class WriteService:
+    """Очередь записи файлов на пуле потоков.
+
+    submit(path, produce) ставит запись в очередь: produce() -> bytes выполняется в потоке
+    пула (например, PNG-кодирование), результат пишется через atomic_write. Пока запись
+    пути ждёт в очереди, новая запись того же пути заменяет её (возвращается тот же
+    Future), а записи одного пути никогда не выполняются одновременно. flush() дожидается
+    всех поставленных записей.
+    """
+
+    def __init__(self, workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="writer")
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = {}
+        self._running = set()
+        self.written = 0
+        self.coalesced = 0
+
+    def submit(self, path, produce):
+        path = os.path.abspath(path)
+        with self._lock:
+            job = self._pending.get(path)
+            if job is not None:
+                job[0] = produce
+                self.coalesced += 1
+                return job[1]
+            future = Future()
+            self._pending[path] = [produce, future]
+            if path not in self._running:
+                self._executor.submit(self._run, path)
+        return future
+
+    def write_bytes(self, path, data):
+        return self.submit(path, lambda: data)
+
+    def write_image(self, path, image, format="PNG"):
+        # Изображение кодируется в потоке пула: вызывающий не должен менять его после передачи
+        return self.submit(path, lambda: image_bytes(image, format))
+
+    def write_json(self, path, data):
+        # Сериализация сразу: в очередь попадает снимок данных на момент вызова
+        return self.write_bytes(path, json.dumps(data).encode("utf-8"))
+
+    def _run(self, path):
+        with self._lock:
+            produce, future = self._pending.pop(path)
+            self._running.add(path)
+        try:
+            atomic_write(path, produce())
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(path)
+            with self._lock:
+                self.written += 1
+        with self._lock:
+            self._running.discard(path)
+            if path in self._pending:
+                # Пока шла запись, путь поставили в очередь снова
+                self._executor.submit(self._run, path)
+            elif not self._pending and not self._running:
+                self._idle.notify_all()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending) + len(self._running)
+
+    def flush(self, timeout=None):
+        """Ждёт завершения всех записей; False, если не успели за timeout секунд."""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending and not self._running, timeout)
+
+    def shutdown(self):
+        self.flush()
+        self._executor.shutdown(wait=True)